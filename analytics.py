@@ -0,0 +1,170 @@
+import threading
+import numpy as np
+import pandas as pd
+import functions
+
+# trailing windows, in months, offered for rolling means, trends and volatility
+ANALYTICS_WINDOWS = [3, 6, 12]
+ANALYTICS_MEASURES = functions.CUBE_MEASURES + functions.DERIVED_MEASURES
+RANK_MEASURES = ['Occupancy_Percent', 'Capacity_100k']
+VOLATILITY_MEASURE = 'Occupancy_Percent'
+
+_analytics_cache = {}
+_analytics_lock = threading.Lock()
+
+
+def _calendar(cube):
+    # cube months on a gap-free monthly axis, so windows and year-on-year lags count calendar months
+    periods = cube['dates'].year * 12 + cube['dates'].month - 1
+    dates = pd.date_range(cube['dates'][0], cube['dates'][-1], freq='MS')
+    return dates, periods - periods[0]
+
+
+def _locations(cube):
+    # one column per location: the nation, then each region, then each ICB
+    names = np.concatenate([['National'], cube['regions'], cube['icb_names']])
+    levels = np.array(['National'] + ['Region'] * len(cube['regions']) + ['ICB'] * len(cube['icb_names']))
+    return names, levels
+
+
+def _window_sums(values, window):
+    # sums over each month's trailing window, NaN months skipped, from one cumulative sum
+    cumulative = np.concatenate([np.zeros((1,) + values.shape[1:]), np.nancumsum(values, axis=0)])
+    end = np.arange(1, len(values) + 1)
+    return cumulative[end] - cumulative[np.maximum(end - window, 0)]
+
+
+def _window_stats(values, window):
+    # rolling mean, least-squares slope per month and standard deviation, only over complete windows
+    valid = ~np.isnan(values)
+    t = np.broadcast_to(np.arange(len(values), dtype=float)[:, None], values.shape)
+    y = np.where(valid, values, 0.0)
+    n = _window_sums(valid.astype(float), window)
+    sum_t = _window_sums(np.where(valid, t, 0.0), window)
+    sum_y = _window_sums(y, window)
+    sum_ty = _window_sums(t * y, window)
+    sum_tt = _window_sums(np.where(valid, t * t, 0.0), window)
+    sum_yy = _window_sums(y * y, window)
+
+    complete = n == window
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.where(complete, sum_y / n, np.nan)
+        slope = np.where(complete, (n * sum_ty - sum_t * sum_y) / (n * sum_tt - sum_t ** 2), np.nan)
+        variance = np.where(complete, (sum_yy - sum_y ** 2 / n) / (n - 1), np.nan)
+    return mean, slope, np.sqrt(np.clip(variance, 0, None))
+
+
+def _lag(values, months):
+    previous = np.full(values.shape, np.nan)
+    previous[months:] = values[:-months]
+    return previous
+
+
+def compute_analytics(cube, window=ANALYTICS_WINDOWS[0]):
+    # rolling, year-on-year and rank analytics for every month and location in one pass over the cube
+    dates, rows = _calendar(cube)
+    names, levels = _locations(cube)
+
+    values = np.full((len(ANALYTICS_MEASURES), len(dates), len(names)), np.nan)
+    for i, measure in enumerate(ANALYTICS_MEASURES):
+        values[i, rows] = np.column_stack([cube['national'][measure], cube['region'][measure], cube['icb'][measure]])
+    # regions are rolled up from reporting ICBs, so are zero rather than missing for months without data
+    values[:, ~np.isin(np.arange(len(dates)), rows)] = np.nan
+
+    # stack the measures along the location axis so each window statistic is computed once for all of them
+    stacked = values.transpose(1, 0, 2).reshape(len(dates), -1)
+    mean, slope, std = (stat.reshape(len(dates), len(ANALYTICS_MEASURES), len(names)).transpose(1, 0, 2)
+                        for stat in _window_stats(stacked, window))
+
+    previous_year = _lag(values.transpose(1, 0, 2), 12).transpose(1, 0, 2)
+    yoy = values - previous_year
+    with np.errstate(divide='ignore', invalid='ignore'):
+        yoy_percent = np.round(yoy / np.where(previous_year == 0, np.nan, previous_year) * 100, 2)
+
+    # ranks are within a level, 1 for the highest value, and rank change is positive for a climb
+    rank, rank_change = {}, {}
+    for measure in RANK_MEASURES:
+        ranks = np.full((len(dates), len(names)), np.nan)
+        for level in ('Region', 'ICB'):
+            columns = levels == level
+            ranks[:, columns] = pd.DataFrame(values[ANALYTICS_MEASURES.index(measure)][:, columns]).rank(
+                axis=1, ascending=False, method='min').to_numpy()
+        rank[measure] = ranks
+        rank_change[measure] = _lag(ranks, 1) - ranks
+
+    volatility = std[ANALYTICS_MEASURES.index(VOLATILITY_MEASURE)]
+    return {
+        'dates': dates,
+        'names': names,
+        'levels': levels,
+        'window': window,
+        'value': dict(zip(ANALYTICS_MEASURES, values)),
+        'rolling_mean': dict(zip(ANALYTICS_MEASURES, mean)),
+        'trend': dict(zip(ANALYTICS_MEASURES, slope)),
+        'yoy': dict(zip(ANALYTICS_MEASURES, yoy)),
+        'yoy_percent': dict(zip(ANALYTICS_MEASURES, yoy_percent)),
+        'volatility': volatility,
+        'rank': rank,
+        'rank_change': rank_change,
+    }
+
+
+def get_analytics(cube, window=ANALYTICS_WINDOWS[0]):
+    # analytics are cached alongside the cube for its data version, one entry per window
+    version = cube.get('version')
+    if version is None:
+        return compute_analytics(cube, window)
+    key = (version, window)
+    with _analytics_lock:
+        analytics = _analytics_cache.get(key)
+        functions.count_cache('analytics', analytics is not None)
+        if analytics is None:
+            # drop windows computed for an older data version
+            for stale in [cached for cached in _analytics_cache if cached[0] != version]:
+                del _analytics_cache[stale]
+            with functions.timed_stage(f'compute_analytics {window}'):
+                analytics = _analytics_cache[key] = compute_analytics(cube, window)
+    return analytics
+
+
+def location_trends(analytics, location='National'):
+    # monthly values of a location with their rolling mean, trend and year-on-year change
+    j = int(np.flatnonzero(analytics['names'] == location)[0])
+    trends = pd.DataFrame({'Date': analytics['dates']})
+    for measure in ANALYTICS_MEASURES:
+        trends[measure] = analytics['value'][measure][:, j]
+        trends[f'{measure}_rolling'] = analytics['rolling_mean'][measure][:, j]
+        trends[f'{measure}_trend'] = analytics['trend'][measure][:, j]
+        trends[f'{measure}_yoy'] = analytics['yoy'][measure][:, j]
+        trends[f'{measure}_yoy_percent'] = analytics['yoy_percent'][measure][:, j]
+    trends['Volatility'] = analytics['volatility'][:, j]
+    return trends.dropna(subset=ANALYTICS_MEASURES, how='all').reset_index(drop=True)
+
+
+def location_summary(analytics, location, year, month):
+    # one row per measure for a month: value, rolling mean, trend per month and year-on-year change
+    i = analytics['dates'].get_loc(pd.Timestamp(year, month, 1))
+    j = int(np.flatnonzero(analytics['names'] == location)[0])
+    window = analytics['window']
+    return pd.DataFrame({
+        'Value': [analytics['value'][measure][i, j] for measure in ANALYTICS_MEASURES],
+        f'{window}-Month Mean': [analytics['rolling_mean'][measure][i, j] for measure in ANALYTICS_MEASURES],
+        'Trend per Month': [analytics['trend'][measure][i, j] for measure in ANALYTICS_MEASURES],
+        'Year-on-Year Change': [analytics['yoy'][measure][i, j] for measure in ANALYTICS_MEASURES],
+        'Year-on-Year %': [analytics['yoy_percent'][measure][i, j] for measure in ANALYTICS_MEASURES],
+    }, index=pd.Index(ANALYTICS_MEASURES, name='Metric'))
+
+
+def rankings(analytics, year, month, measure='Occupancy_Percent', level='ICB'):
+    # ICBs or regions ranked on a measure for a month, with their rank change, year-on-year change and volatility
+    i = analytics['dates'].get_loc(pd.Timestamp(year, month, 1))
+    columns = analytics['levels'] == level
+    ranked = pd.DataFrame({
+        'Rank': analytics['rank'][measure][i, columns],
+        'Rank Change': analytics['rank_change'][measure][i, columns],
+        measure: analytics['value'][measure][i, columns],
+        f'{analytics["window"]}-Month Mean': analytics['rolling_mean'][measure][i, columns],
+        'Year-on-Year Change': analytics['yoy'][measure][i, columns],
+        'Volatility': analytics['volatility'][i, columns],
+    }, index=pd.Index(analytics['names'][columns], name=level))
+    return ranked.dropna(subset=['Rank']).sort_values(['Rank', level])
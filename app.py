@@ -1,258 +1,181 @@
 import calendar
-import json
+import logging
 import os
-import numpy as np
 import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
 import streamlit as st
+import analytics
+import figures
 import functions
-
-GEOJSON_PATH = "./data/geodata/ICB2023.geojson"
+from store import data_store, refresh_worker
+
+# geometry tier drawn on the maps, see functions.GEOJSON_TIERS
+GEOMETRY_TIER = "low"
+# ICB tables shown per page in the Pivot View
+PIVOT_PAGE_SIZE = 10
+# seconds between background checks for new reports, 0 leaves polling off
+REFRESH_POLL_SECONDS = int(os.environ.get('SITREP_REFRESH_POLL_SECONDS', 0))
+# seconds between progress updates while a refresh this session started is running
+REFRESH_STATUS_SECONDS = 1
+
+# log start-up timings and other diagnostics
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
 # Set pandas display option
 pd.options.display.float_format = '{:,.2f}'.format
+# started once per process, whichever session runs first
+refresh_worker.poll(REFRESH_POLL_SECONDS)
 
-# load virtual ward data
-vw_data = pd.DataFrame(functions.get_vw_dataset())
-
-# open geodata
-if os.path.exists(GEOJSON_PATH):
-    pass
-else:
-    functions.convert_shape_to_json()
-
-with open(GEOJSON_PATH) as geo_file:
-    geojson_data = json.load(geo_file)
-
-# streamlit formatting
+# streamlit formatting, rendered before any data is loaded
 st.title("NHS Virtual Wards SITREP Data")
 st.sidebar.title('Selections')
 
 # streamlit views select box
-views = ["National Overview", "Time Series & ICB Performance", "Pivot View"]
+views = ["National Overview", "Time Series & ICB Performance", "Trends & Rankings", "Pivot View"]
+# views showing a single month
+dated_views = ["National Overview", "Trends & Rankings"]
 view = st.sidebar.selectbox("Select a View", views)
 
+# virtual ward data and its precomputed month x ICB cube, one shared copy per data version for every session
+with st.spinner('Loading virtual ward data...'):
+    data = data_store.get()
+vw_data = data['dataset']
+cube = data['cube']
+
 # instantiate date selection variable
-dates_df = pd.DataFrame()
-dates_df['Year'] = vw_data['Date'].dt.year
-dates_df['Month'] = vw_data['Date'].dt.month
-date_combinations = dates_df.drop_duplicates(subset=['Year', 'Month'])[['Year', 'Month']].sort_values(
-    ['Year', 'Month'], ascending=False).values.tolist()
+date_combinations = [[date.year, date.month] for date in cube['dates'][::-1]]
 
 # streamlit date select box, conditional on the selected view
-if view == "National Overview":
+if view in dated_views:
     selected_date = st.sidebar.selectbox('Select a Year and Month',
                                          options=date_combinations,
                                          format_func=lambda date: f"{calendar.month_name[date[1]]} {date[0]}")
 
-    vw_data_time_filtered = vw_data[(vw_data['Date'].dt.year == selected_date[0]) & (vw_data['Date'].dt.month == selected_date[1])]
-
     # new variable for displaying date time in titles
     formatted_date = f"{calendar.month_name[selected_date[1]]} {selected_date[0]}"
 else:
-    vw_data_time_filtered = vw_data
     formatted_date = ""
 
+# maps with a month slider that plays in the browser, in place of the selected month's maps
+animate_maps = view == "National Overview" and st.sidebar.toggle(
+    'Month Slider Maps', help=f'Step through the last {functions.MAP_FRAME_MONTHS} months on the maps')
+
 # streamlit select box for ICB, conditional on view
-icb_locations = sorted(vw_data['ICB23NMS'].unique().tolist())
+icb_locations = sorted(cube['name_index'])
 icb_locations_with_select_all = ['National'] + icb_locations
 if view == "National Overview":
     selected_location = 'National'
+elif view == "Trends & Rankings":
+    # regions have trends too
+    selected_location = st.sidebar.selectbox('Select a Location',
+                                             options=['National'] + list(cube['regions']) + icb_locations)
+    analytics_window = st.sidebar.select_slider('Rolling Window (Months)', options=analytics.ANALYTICS_WINDOWS)
 else:
     selected_location = st.sidebar.selectbox('Select an ICB Location', options=icb_locations_with_select_all)
 
-if selected_location != 'National':
-    filtered_data = vw_data[vw_data['ICB23NMS'] == selected_location]
-else:
-    filtered_data = vw_data
+# streamlit refresh data button, the refresh runs in the background so pages keep rendering meanwhile
+st.sidebar.write("")
+st.sidebar.write("")
+if st.sidebar.button('Check for New Reports & Refresh Data'):
+    # start a refresh, or follow the one another session or the poller already started
+    refresh_worker.start()
+    st.session_state['refresh_started'] = True
+
+
+@st.experimental_fragment(run_every=REFRESH_STATUS_SECONDS)
+def refresh_status():
+    status = refresh_worker.status()
+    if status['state'] == 'downloading':
+        st.progress(status['done'] / status['total'] if status['total'] else 0.0,
+                    text=f"Checking for new reports... {status['done']} of {status['total'] or '?'}")
+        return
+    if status['state'] == 'loading':
+        st.progress(1.0, text=f"Loading {status['new']} new monthly report(s)...")
+        return
+
+    del st.session_state['refresh_started']
+    if status['state'] == 'failed':
+        st.session_state['refresh_message'] = ('error', f"Data refresh failed: {status['error']}")
+    else:
+        st.session_state['refresh_message'] = ('success', f"Data refreshed successfully! {status['new']} new monthly report(s), {status['total']} existing monthly report(s) loaded.")
+    # rerun the whole page on the refreshed data
+    st.rerun()
+
+
+if st.session_state.get('refresh_started'):
+    with st.sidebar:
+        refresh_status()
+if 'refresh_message' in st.session_state:
+    level, message = st.session_state.pop('refresh_message')
+    if level == 'error':
+        st.error(message)
+    else:
+        st.success(message)
 
-# created grouped dataframe for All_ICB selection
-total_occupancy_capacity = filtered_data.groupby('Date')[
-    ['Occupancy', 'Capacity', 'GP_Registered_Population']].sum().reset_index()
-total_occupancy_capacity['Occupancy_Percent'] = ((total_occupancy_capacity['Occupancy'] / total_occupancy_capacity[
-    'Capacity'].replace(0, np.nan)) * 100).round(2)
-total_occupancy_capacity['Capacity_100k'] = ((total_occupancy_capacity['Capacity'] / total_occupancy_capacity[
-    'GP_Registered_Population'].replace(0, np.nan)) * 100000).round(2)
+# figures are cached across reruns and sessions on the selection and data version
+figure_key = (view, tuple(selected_date) if view in dated_views else None, selected_location, cube['version'])
 
 
+def load_geometry():
+    # geodata is only opened when a map is built, one simplified geometry object shared by both maps
+    with functions.timed_stage('load geometry'):
+        return data_store.geometry(GEOMETRY_TIER)
+
+
+def chart(name, build, key=None):
+    # time each chart end to end, a cached figure's rehydration included, and count figure cache hits
+    def timed_build():
+        with functions.timed_stage(f'build figure {name}'):
+            return build()
+
+    with functions.timed_stage(f'chart {name}'):
+        fig, hit = figures.lookup_figure(name, key or figure_key, timed_build)
+        st.plotly_chart(fig)
+    functions.count_cache('figure', hit)
+
+
+def table(name, build):
+    # time building and rendering a styled table
+    with functions.timed_stage(f'table {name}'):
+        st.table(build())
+
+
+def movers_table(feature, lag):
+    # top 5 movers are numeric, formatting is left to the display
+    top_df = functions.top_movers(cube, selected_date[0], selected_date[1], feature, lag, 5)
+    return top_df.style.format('{:,.0f}').format('{:,.2f}%', subset=['Percentage Increase'])
+
+
+def format_pivot(pivot_table):
+    # counts as whole numbers and percentages to 2 dp, with months as Month-Year columns
+    pivot_table = pivot_table.rename(columns=lambda date: date.strftime('%B-%Y'))
+    return pivot_table.style.format('{:.0f}', na_rep='').format(
+        '{:.2f}', na_rep='', subset=pd.IndexSlice[['Occupancy_Percent'], :])
 
-# streamlit refresh data button
-st.sidebar.write("")
-st.sidebar.write("")
-if st.sidebar.button('Check for New Reports & Refresh Data'):
-    new_download_count, total_download_count = functions.download_and_rename_files()
-    st.success(f'Data refreshed successfully! {new_download_count} new monthly report(s), {total_download_count} existing monthly report(s) loaded.')
-
-# Construct Figure 0: Choropleth graph
-fig = go.Figure(
-    go.Choroplethmapbox(
-        geojson=geojson_data,
-        locations=vw_data_time_filtered['ICB23CD'],
-        featureidkey='properties.ICB23CD',
-        z=vw_data_time_filtered['Occupancy_Percent'],
-        customdata=vw_data_time_filtered[['Occupancy', 'Capacity', 'Capacity_100k', 'GP_Registered_Population']],
-        text=vw_data_time_filtered['ICB23NMS'],
-        colorscale=px.colors.diverging.RdYlGn[::-1],
-        hovertemplate=(
-            '<b>%{text}</b><br>'
-            '<extra><br><br><b>%{z:.2f}%</b></extra>'
-            'Reported Occupancy: %{customdata[0]}<br>'
-            'Reported Capacity: %{customdata[1]}<br>'
-            'Capacity per 100k GP Registered Patients: %{customdata[2]}<br>'
-            'GP Registered Population: %{customdata[3]:,.0f}<br>'),
-        zmin=0,
-        zmax=100,
-    )
-)
-fig.update_layout(
-    mapbox_style="carto-positron",
-    mapbox_zoom=5,
-    mapbox_center={"lat": 52.37, "lon": -0.5},
-    width=800,
-    height=600,
-    title=dict(text=f"National Snapshot of Occupancy (% of Capacity) for {formatted_date}", font=dict(size=18, family='sans-serif')),
-    margin={"r": 0, "t": 30, "l": 0, "b": 0},
-    hoverlabel=dict(bgcolor="white", font_size=13, font_family="sans-serif")
-)
-
-# Construct Figure 1: Choropleth graph
-fig1 = go.Figure(
-    go.Choroplethmapbox(
-        geojson=geojson_data,
-        locations=vw_data_time_filtered['ICB23CD'],
-        featureidkey='properties.ICB23CD',
-        z=vw_data_time_filtered['Capacity_100k'],
-        customdata=vw_data_time_filtered[['Occupancy', 'Capacity', 'Occupancy_Percent', 'GP_Registered_Population']],
-        text=vw_data_time_filtered['ICB23NMS'],
-        colorscale='RdYlGn',
-        zmin=0,
-        zmax=40,
-        hovertemplate=(
-            '<b>%{text}</b><br>'
-            '<extra><b><br><br>%{z}</b></extra>'
-            'Reported Occupancy: %{customdata[0]}<br>'
-            'Reported Capacity: %{customdata[1]}<br>'
-            'Occupancy Percent: %{customdata[2]} %<br>'
-            'GP Registered Population:</b> %{customdata[3]:,}<br>'
-        )
-    )
-)
-
-fig1.update_layout(
-    mapbox_style="carto-positron",
-    mapbox_zoom=5,
-    mapbox_center={"lat": 52.37, "lon": -0.5},
-    width=800,
-    height=600,
-    margin={"r": 0, "t": 30, "l": 0, "b": 0},
-    title=dict(text=f"National Snapshot of Capacity (per 100K GP Registered Patients) for {formatted_date}", font=dict(size=18, family='sans-serif')),
-    hoverlabel=dict(bgcolor="white", font_size=13, font_family="sans-serif")
-)
-
-# Construct Figure 2: Line Graph
-fig2 = go.Figure()
-fig2.add_trace(
-    go.Scatter(
-        x=total_occupancy_capacity['Date'],
-        y=total_occupancy_capacity['Occupancy'],
-        mode='lines+markers',
-        name='Occupancy',
-        customdata=total_occupancy_capacity['Date'].dt.strftime('%B %Y')
-    )
-)
-
-fig2.add_trace(
-    go.Scatter(
-        x=total_occupancy_capacity['Date'],
-        y=total_occupancy_capacity['Capacity'],
-        mode='lines+markers',
-        name='Capacity',
-        customdata=total_occupancy_capacity['Date'].dt.strftime('%B %Y')
-    )
-)
-
-fig2.update_layout(
-    title='Occupancy and Capacity Over Time for {}'.format(selected_location),
-    xaxis_title='Date',
-    yaxis_title='Value',
-)
-
-# Construct Figure3: Line Graph
-fig3 = go.Figure()
-fig3.add_trace(
-    go.Scatter(
-        x=total_occupancy_capacity['Date'],
-        y=total_occupancy_capacity['Occupancy_Percent'],
-        mode='lines+markers',
-        name='Occupancy',
-        customdata=total_occupancy_capacity['Date'].dt.strftime('%B %Y')
-    )
-)
-fig3.update_layout(
-    title='Occupancy % Over Time for {}'.format(selected_location),
-    xaxis_title='Date',
-    yaxis_title='Percent (%)',
-    )
-# Construct Figure 4: Line Graph
-fig4 = go.Figure()
-fig4.add_trace(
-    go.Scatter(
-        x=total_occupancy_capacity['Date'],
-        y=total_occupancy_capacity['Capacity_100k'],
-        mode='lines+markers',
-        name='Capacity per 100K',
-        customdata=total_occupancy_capacity['Date'].dt.strftime('%B %Y')
-    )
-)
-fig4.update_layout(
-    title='Capacity per 100k GP Registered Patients Over Time for {}'.format(selected_location),
-    xaxis_title='Date',
-    yaxis_title='Capacity per 100k',
-    )
-
-# Construct Figure 5: Line Graph
-fig5 = go.Figure()
-fig5.add_trace(
-    go.Scatter(
-        x=total_occupancy_capacity['Date'],
-        y=total_occupancy_capacity['GP_Registered_Population'],
-        mode='lines+markers',
-        name='GP Registered Population',
-        customdata=total_occupancy_capacity['Date'].dt.strftime('%B %Y')
-    )
-)
-fig5.update_layout(
-    title='GP Registered Population for {}'.format(selected_location),
-    xaxis_title='Date',
-    yaxis_title='Population',
-    )
-
-# Update y-axis to 0 for scatters
-fig2.update_yaxes(rangemode='tozero')
-fig3.update_yaxes(rangemode='tozero')
-fig4.update_yaxes(rangemode='tozero')
-fig5.update_yaxes(rangemode='tozero')
-
-# Remove display of day of the month from line graph hoverboxes
-fig2.update_traces(hovertemplate='Date: %{customdata}<br>Value: %{y}')
-fig3.update_traces(hovertemplate='Date: %{customdata}<br>Value: %{y}')
-fig4.update_traces(hovertemplate='Date: %{customdata}<br>Value: %{y}')
-fig5.update_traces(hovertemplate='Date: %{customdata}<br>Value: %{y}')
 
 # conditional rules for which plots to chart based on selected view
 if view == "National Overview":
     st.write("#### **Occupancy**")
-    st.plotly_chart(fig)
+    vw_data_time_filtered = functions.cube_month_slice(cube, selected_date[0], selected_date[1])
+    # animated maps are the same for every selected month, so are cached on the data version alone
+    animation_key = (view, None, selected_location, cube['version'])
+    if animate_maps:
+        chart('occupancy_map_animation', lambda: figures.occupancy_map_animation(
+            functions.cube_map_frames(cube), load_geometry()), animation_key)
+    else:
+        chart('occupancy_map', lambda: figures.occupancy_map(vw_data_time_filtered, load_geometry(), formatted_date))
     st.write(f"##### **Top 5 Absolute Occupancy Increases in {formatted_date} from the Month Prior**")
-    st.table(functions.calculate_topn(vw_data, selected_date[0], selected_date[1], 1, 'Occupancy', 5))
+    table('movers Occupancy 1', lambda: movers_table('Occupancy', 1))
     st.write("\n")
     st.write("#### **Capacity**")
-    st.plotly_chart(fig1)
+    if animate_maps:
+        chart('capacity_map_animation', lambda: figures.capacity_map_animation(
+            functions.cube_map_frames(cube), load_geometry()), animation_key)
+    else:
+        chart('capacity_map', lambda: figures.capacity_map(vw_data_time_filtered, load_geometry(), formatted_date))
     st.write("\n")
     st.write(f"##### **Top 5 Absolute Capacity Increases in {formatted_date} from the Month Prior**")
-    st.table(functions.calculate_topn(vw_data, selected_date[0], selected_date[1], 1, 'Capacity', 5))
+    table('movers Capacity 1', lambda: movers_table('Capacity', 1))
     st.write(f"##### **Top 5 Absolute Capacity Increases in {formatted_date} from 6 Months Prior**")
-    st.table(functions.calculate_topn(vw_data, selected_date[0], selected_date[1], 6, 'Capacity', 5))
+    table('movers Capacity 6', lambda: movers_table('Capacity', 6))
     st.write("\n#### **Notes**")
     st.write("Note 1: GP registered population does not include patients less than 16 years old prior to April 2024.")
     st.write("Note 2: The data contains the number of patients on a virtual ward, at 8am Thursday prior to the sitrep submission period. For example, 8am Thursday 23rd May 2024 for May 2024 published data.")
@@ -260,53 +183,70 @@ if view == "National Overview":
 
 elif view == "Time Series & ICB Performance":
     st.write("#### **Time Series & ICB Performance**")
-    st.plotly_chart(fig2)
-    st.plotly_chart(fig3)
-    st.plotly_chart(fig4)
-    st.plotly_chart(fig5)
+    # monthly totals for the selected location, read from the cube
+    total_occupancy_capacity = functions.cube_location_series(cube, selected_location)
+    for name, build in [('occupancy_capacity', figures.occupancy_capacity_series),
+                        ('occupancy_percent', figures.occupancy_percent_series),
+                        ('capacity_100k', figures.capacity_100k_series),
+                        ('gp_population', figures.gp_population_series)]:
+        chart(name, lambda: build(total_occupancy_capacity, selected_location))
     st.write("\n#### **Notes**")
     st.write("Note 1: GP registered population does not include patients less than 16 years old prior to April 2024.")
     st.write("Note 2: The data contains the number of patients on a virtual ward, at 8am Thursday prior to the sitrep submission period. For example, 8am Thursday 23rd May 2024 for May 2024 published data.")
     st.write("More information regarding virtual wards can be found on the NHS England website: https://www.england.nhs.uk/virtual-wards/")
 
+elif view == "Trends & Rankings":
+    # rolling, year-on-year and rank analytics, computed once per data version and window for every location
+    cube_analytics = analytics.get_analytics(cube, analytics_window)
+    trends = analytics.location_trends(cube_analytics, selected_location)
+    st.write(f"#### **Trends for {selected_location}**")
+    for name, build in [('occupancy_percent_trend', figures.occupancy_percent_trend),
+                        ('capacity_100k_trend', figures.capacity_100k_trend),
+                        ('occupancy_volatility', figures.occupancy_volatility_series)]:
+        chart(f'{name} {analytics_window}', lambda: build(trends, selected_location, analytics_window))
+    st.write(f"##### **{selected_location} in {formatted_date}**")
+    table('analytics summary', lambda: analytics.location_summary(
+        cube_analytics, selected_location, *selected_date).style.format('{:,.2f}', na_rep=''))
+
+    st.write(f"#### **Occupancy % Rankings for {formatted_date}**")
+    st.write("Rank 1 is the highest occupancy, a positive rank change is a climb since the month prior.")
+    for level in ('Region', 'ICB'):
+        table(f'rankings {level}', lambda: analytics.rankings(
+            cube_analytics, *selected_date, level=level).style.format('{:,.2f}', na_rep='').format(
+            '{:+.0f}', na_rep='', subset=['Rank Change']).format('{:.0f}', subset=['Rank']))
+    st.write("\n#### **Notes**")
+    st.write(f"Rolling means, trends and volatility cover the {analytics_window} months up to each month, and are blank until that much history exists.")
+    st.write("Volatility is the standard deviation of monthly Occupancy %, in percentage points.")
+
 else:
     st.write("#### **Pivot View**")
-    # Pivot Source
-    pivot_data = filtered_data[['ICB23NMS', 'Date', 'Capacity', 'Occupancy', 'GP_Registered_Population', 'Occupancy_Percent']]
-    pivot_data = pivot_data.round(2)
-    # Identify unique ICB list and sort
-    unique_ICB = pivot_data['ICB23NMS'].unique()
-    unique_ICB = np.sort(unique_ICB)
+    # one prebuilt (location, metric) x month table, sliced per ICB for the current page
+    pivot = functions.get_pivot(cube)
 
     if selected_location == 'National':
         # Plot the national aggregated table
-        table_data_nat = pivot_data
-        table_data_nat.drop('ICB23NMS', axis=1, inplace=True)
-        table_data_nat.drop('Occupancy_Percent', axis=1, inplace=True)
-        table_data_nat = table_data_nat.groupby('Date').agg({
-            'Capacity': 'sum',
-            'Occupancy': 'sum',
-            'GP_Registered_Population': 'sum',
-        })
-        table_data_nat['Occupancy_Percent'] = (table_data_nat['Occupancy'] / table_data_nat['Capacity']) * 100
-        table_data_nat = table_data_nat.applymap(lambda x: '{0:.2f}'.format(x) if isinstance(x, float) else x)
-        pivot_table_nat = pd.pivot_table(table_data_nat, index='Date', aggfunc='sum').T.sort_index(axis=1, ascending=False)
-
-        # Reformat date field
-        pivot_table_nat.columns = pivot_table_nat.columns.strftime('%B-%Y')
         st.write(f"###### **National**")
-        st.table(pivot_table_nat)
+        table('pivot', lambda: format_pivot(pivot.loc['National']))
+        pivot_icbs = icb_locations
     else:
-        pass
-    pivot_data = filtered_data[['ICB23NMS', 'Date', 'Capacity', 'Occupancy', 'GP_Registered_Population', 'Occupancy_Percent']]
-    # Iterate through the ICB and plot the table
-    for icb in unique_ICB:
-        table_data = pivot_data[pivot_data['ICB23NMS'] == icb]
-        table_data.drop('ICB23NMS', axis=1, inplace=True)
-        table_data = table_data.applymap(lambda x: '{0:.2f}'.format(x) if isinstance(x, float) else x)
-        pivot_table = pd.pivot_table(table_data, index='Date', aggfunc='sum').T.sort_index(axis=1, ascending=False)
-        # Reformat date field
-        pivot_table.columns = pivot_table.columns.strftime('%B-%Y')
+        pivot_icbs = [selected_location]
+
+    page_count = -(-len(pivot_icbs) // PIVOT_PAGE_SIZE)
+    page = st.number_input(f'Page (of {page_count})', min_value=1, max_value=page_count) if page_count > 1 else 1
+    for icb in pivot_icbs[(page - 1) * PIVOT_PAGE_SIZE:page * PIVOT_PAGE_SIZE]:
         st.write(f"###### **{icb}**")
-        st.table(pivot_table)
+        table('pivot', lambda: format_pivot(pivot.loc[icb]))
+
+# optional timings, cache counters and memory for this process, to find hot spots under load
+if st.sidebar.checkbox('Show diagnostics'):
+    with st.sidebar.expander('Stage timings', expanded=True):
+        st.table(functions.stage_report().style.format('{:.3f}').format('{:,.0f}', subset=['calls']))
+
+    with st.sidebar.expander('Caches', expanded=True):
+        st.table(functions.cache_report().style.format('{:,.0f}').format('{:.0%}', subset=['hit_rate'], na_rep=''))
+        st.caption(f"Figure cache holds {figures.figure_cache.size / 2 ** 20:,.1f} MiB")
 
+    with st.sidebar.expander('Dataset memory'):
+        memory = functions.memory_report(vw_data)
+        st.caption(f"{memory['Bytes'].sum() / 1024:,.1f} KiB across {len(vw_data):,} rows")
+        st.table(memory.style.format({'Bytes': '{:,.0f}', 'Percent': '{:.1f}%'}))
@@ -0,0 +1,298 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import shutil
+import time
+import tracemalloc
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+import plotly.io as pio
+import figures
+import functions
+import snapshot
+
+PREAMBLE_ROWS = 15
+NON_NUMERIC_VALUES = ['-', '*', ' ', 'N/A']
+FOOTNOTE = '* Synthetic footnote, as the published sheets carry below the table.'
+# stages that parse workbooks, in worker processes tracemalloc can't see when --workers > 1
+PARSE_STAGES = ['load_data', 'load_data_incremental_cold', 'load_data_streaming', 'get_vw_dataset_cold']
+
+
+def synthetic_sheet(n_icbs, rng):
+    # raw 'Virtual Ward Data' sheet as read by pd.read_excel: preamble, header row, ENGLAND summary row, ICB rows
+    header = [np.nan, 'Region', 'Region Code', 'ICB code', 'Name', 'Virtual Ward Capacity',
+              'Virtual Ward Capacity per 100,000', 'GP registered population', 'Patients in a Virtual Ward',
+              'Occupancy %']
+    capacity = rng.integers(0, 1000, n_icbs).astype(object)
+    population = rng.integers(100000, 3000000, n_icbs).astype(object)
+    occupancy = rng.integers(0, 1000, n_icbs).astype(object)
+
+    # sprinkle the non-numeric cells the real submissions contain
+    for column in (capacity, population, occupancy):
+        bad = rng.random(n_icbs) < 0.02
+        column[bad] = rng.choice(NON_NUMERIC_VALUES, bad.sum())
+
+    rows = [[np.nan, f'Preamble {i}:'] + [np.nan] * 8 for i in range(PREAMBLE_ROWS)]
+    rows.append(header)
+    rows.append([np.nan, '-', '-', '-', 'ENGLAND', 1, 1.0, 1, 1, 1.0])
+    for i in range(n_icbs):
+        rows.append([np.nan, f'Region {i % 7}', f'Y{i % 7}', f'Q{i:02d}', f'NHS ICB {i} Integrated Care Board',
+                     capacity[i], 1.0, population[i], occupancy[i], 0.5])
+    return pd.DataFrame(rows)
+
+
+def _legacy_clean(df, file_date):
+    # the row-wise cleaning load_data() used before it was vectorized, kept as a baseline
+    header_index = df[df.apply(lambda row: row.astype(str).str.contains(functions.HEADER_KEYWORD).any(), axis=1)].index[0]
+    table_data = df.iloc[header_index:].copy()
+    table_data.columns = table_data.iloc[0]
+    table_data = table_data[1:]
+    table_data['Date'] = file_date
+    table_data = table_data[~(table_data == 'ENGLAND').any(axis=1)]
+    table_data = table_data[~(table_data == 'ENGLAND*').any(axis=1)]
+    table_data = table_data.drop([table_data.columns[i] for i in [0, 6, 9]], axis=1)
+    table_data = functions._clean_column_names(table_data)
+    cols = list(table_data.columns)
+    for col in cols[4:7]:
+        table_data[col] = table_data[col].apply(_safe_convert).astype('Int64')
+    table_data.columns = ['Region', 'Region_Code', 'ICB_Code', 'Name', 'Capacity', 'GP_Registered_Population',
+                          'Occupancy', 'Date']
+    table_data['Date'] = pd.to_datetime(table_data['Date'], format='%Y%m')
+    table_data['Date'] = table_data['Date'].apply(lambda date: date.replace(day=1))
+    return table_data
+
+
+def _safe_convert(val):
+    try:
+        return float(val)
+    except ValueError:
+        return np.nan
+
+
+def _vectorized_clean(df, file_date):
+    table_data = functions._clean_table(df.iloc[functions._find_header_index(df):], file_date)
+    table_data['Date'] = pd.to_datetime(table_data['Date'], format='%Y%m')
+    return table_data
+
+
+def _file_dates(months):
+    dates = pd.date_range('1990-01-01', periods=months, freq='MS')
+    return dates.strftime('%Y%m').tolist()
+
+
+def bench_cleaning(months, icbs, seed=0):
+    rng = np.random.default_rng(seed)
+    sheets = [(synthetic_sheet(icbs, rng), file_date) for file_date in _file_dates(months)]
+
+    results = {}
+    for name, clean in (('legacy', _legacy_clean), ('vectorized', _vectorized_clean)):
+        start = time.perf_counter()
+        pd.concat([clean(df, file_date) for df, file_date in sheets])
+        results[name] = time.perf_counter() - start
+    return results
+
+
+def write_workbook(file_path, sheet):
+    # a workbook in the published layout: a Notes sheet, then the data sheet followed by a blank row and a footnote
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    wb.create_sheet('Notes').append(['Notes'])
+    ws = wb.create_sheet(functions.EXCEL_SHEET)
+    for row in sheet.astype(object).where(sheet.notna(), None).itertuples(index=False):
+        ws.append(list(row))
+    ws.append([])
+    ws.append([None, FOOTNOTE])
+    wb.save(file_path)
+
+
+def write_locations(file_path, n_icbs):
+    # subICSLocations.csv for the synthetic ICBs, so every generated row joins
+    names = [f'NHS ICB {i} Integrated Care Board' for i in range(n_icbs)]
+    pd.DataFrame({
+        'ICB_Name': names,
+        'ICB23CD': [f'E54{i:06d}' for i in range(n_icbs)],
+        'ICB23NM': names,
+        'NHSER23CD': [f'E40{i % 7:06d}' for i in range(n_icbs)],
+        'NHSER23CDH': [f'Y{i % 7}' for i in range(n_icbs)],
+        'NHSER23NM': [f'Region {i % 7}' for i in range(n_icbs)],
+    }).to_csv(file_path, index=False)
+
+
+def write_dataset(root, months, icbs, seed=0):
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.join(root, functions.DATA_PATH))
+    for file_date in _file_dates(months):
+        file_name = f'{functions.FILE_PREFIX}{file_date}{functions.FILE_EXT}'
+        write_workbook(os.path.join(root, functions.DATA_PATH, file_name), synthetic_sheet(icbs, rng))
+    write_locations(os.path.join(root, functions.LOCATION_DATA_FILE), icbs)
+
+
+def _run_stage(stages, name, func):
+    # wall time and peak traced allocation of one stage, measured from the memory already held
+    gc.collect()
+    tracemalloc.reset_peak()
+    held = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    result = func()
+    stages.append({'stage': name, 'seconds': round(time.perf_counter() - start, 6),
+                   'peak_bytes': tracemalloc.get_traced_memory()[1] - held})
+    return result
+
+
+def _clear_cache():
+    if os.path.exists(functions.CACHE_PATH):
+        shutil.rmtree(functions.CACHE_PATH)
+
+
+def bench_pipeline(months, icbs, workers=1, seed=0):
+    # geometry is read from the repo before switching to the synthetic tree, its ICB codes won't match
+    geometry = functions.load_geometry()
+    cwd = os.getcwd()
+    stages = []
+    with tempfile.TemporaryDirectory() as root:
+        start = time.perf_counter()
+        write_dataset(root, months, icbs, seed)
+        generate_seconds = time.perf_counter() - start
+
+        # the pipeline uses paths relative to the working directory, so run it inside the synthetic tree
+        os.chdir(root)
+        tracemalloc.start()
+        try:
+            _run_stage(stages, 'load_data', lambda: functions.load_data(incremental=False, workers=workers))
+            _run_stage(stages, 'load_data_incremental_cold', lambda: functions.load_data(workers=workers))
+            _run_stage(stages, 'load_data_incremental_warm', lambda: functions.load_data(workers=workers))
+            _clear_cache()
+            _run_stage(stages, 'load_data_streaming', lambda: functions.load_data(workers=workers, streaming=True))
+            _clear_cache()
+            _run_stage(stages, 'get_vw_dataset_cold', lambda: functions.get_vw_dataset(workers=workers))
+            vw_data = _run_stage(stages, 'get_vw_dataset_cached', lambda: functions.get_vw_dataset(workers=workers))
+
+            cube = _run_stage(stages, 'build_cube', lambda: functions.build_cube(vw_data))
+            cube['version'] = 'benchmark'
+            _run_stage(stages, 'compute_movers', lambda: functions.get_movers(cube))
+            # the three National Overview tables for every month
+            _run_stage(stages, 'top_movers', lambda: [
+                functions.top_movers(cube, date.year, date.month, feature, lag)
+                for date in cube['dates'] for feature, lag in snapshot.TOPN_TABLES])
+            latest = cube['dates'][-1]
+            _run_stage(stages, 'calculate_topn', lambda: functions.calculate_topn(
+                vw_data, latest.year, latest.month, 1, 'Occupancy', 5))
+            # the Pivot View builds the pivot once per data version, then slices one table per ICB
+            pivot = _run_stage(stages, 'build_pivot', lambda: functions.get_pivot(cube))
+            _run_stage(stages, 'pivot_slices', lambda: [
+                pivot.loc[name] for name in ['National'] + list(cube['icb_names'])])
+
+            month_data = functions.cube_month_slice(cube, latest.year, latest.month)
+            series = functions.cube_location_series(cube)
+            _run_stage(stages, 'figures', lambda: [pio.to_json(fig, validate=False) for fig in [
+                figures.occupancy_map(month_data, geometry, 'Benchmark'),
+                figures.capacity_map(month_data, geometry, 'Benchmark'),
+                figures.occupancy_capacity_series(series, 'National'),
+                figures.occupancy_percent_series(series, 'National'),
+                figures.capacity_100k_series(series, 'National'),
+                figures.gp_population_series(series, 'National')]])
+        finally:
+            tracemalloc.stop()
+            os.chdir(cwd)
+
+    return {
+        'parameters': {'months': months, 'icbs': icbs, 'workers': workers, 'seed': seed},
+        'environment': _environment(),
+        'generate_seconds': round(generate_seconds, 6),
+        'stages': stages,
+    }
+
+
+def _environment():
+    # enough to tell apart results from different commits and machines
+    commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True).stdout.strip()
+    return {
+        'commit': commit or None,
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def compare_results(baseline, results):
+    # per-stage time and peak memory of results relative to a baseline run, > 1 is slower or larger
+    baseline_stages = {stage['stage']: stage for stage in baseline['stages']}
+    rows = []
+    for stage in results['stages']:
+        before = baseline_stages.get(stage['stage'])
+        if before:
+            rows.append({'stage': stage['stage'],
+                         'seconds': stage['seconds'] / before['seconds'] if before['seconds'] else np.nan,
+                         'peak_bytes': stage['peak_bytes'] / before['peak_bytes'] if before['peak_bytes'] else np.nan})
+    return pd.DataFrame(rows, columns=['stage', 'seconds', 'peak_bytes']).set_index('stage')
+
+
+def bench_imports(modules=('functions', 'figures')):
+    # cumulative import time of each app module in a fresh interpreter, from python -X importtime
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {', '.join(modules)}"],
+                            cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True)
+    results = {}
+    for line in result.stderr.splitlines():
+        _, cumulative, name = line.split('|')
+        # top-level imports are indented by a single space
+        if name.strip() in modules and not name.startswith('  '):
+            results[name.strip()] = int(cumulative) / 1e6
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the SITREP pipeline on synthetic data.')
+    parser.add_argument('--months', type=int, default=1000)
+    parser.add_argument('--icbs', type=int, default=100)
+    parser.add_argument('--imports', action='store_true', help='report module import times instead')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='time each pipeline stage on synthetic workbooks instead of the cleaning step alone')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes for parsing workbooks')
+    parser.add_argument('--output', help='write pipeline results as JSON to this file')
+    parser.add_argument('--compare', help='JSON results of an earlier pipeline run to compare against')
+    args = parser.parse_args()
+
+    if args.imports:
+        for name, seconds in bench_imports().items():
+            print(f"import {name:<12}{seconds:8.3f}s")
+        return
+
+    if args.pipeline:
+        results = bench_pipeline(args.months, args.icbs, args.workers)
+        print(f"pipeline {args.months} months x {args.icbs} ICBs, {results['generate_seconds']:.1f}s to generate")
+        for stage in results['stages']:
+            untraced = '*' if args.workers > 1 and stage['stage'] in PARSE_STAGES else ''
+            print(f"  {stage['stage']:<28}{stage['seconds']:8.3f}s{stage['peak_bytes'] / 2 ** 20:10.1f} MiB{untraced}")
+        if args.workers > 1:
+            print(f"  * peak memory of this process only, the {args.workers} parse workers' memory isn't included")
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+        if args.compare:
+            with open(args.compare) as f:
+                ratios = compare_results(json.load(f), results)
+            print("relative to", args.compare)
+            for stage, row in ratios.iterrows():
+                print(f"  {stage:<28}{row['seconds']:8.2f}x{row['peak_bytes']:9.2f}x")
+        return
+
+    results = bench_cleaning(args.months, args.icbs)
+    print(f"cleaning {args.months} months x {args.icbs} ICBs")
+    for name, seconds in results.items():
+        print(f"  {name:<12}{seconds:8.3f}s")
+    print(f"  speedup     {results['legacy'] / results['vectorized']:8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+import plotly.colors
+import plotly.graph_objects as go
+import plotly.io as pio
+
+FIGURE_CACHE_BYTES = 64 * 1024 * 1024
+# milliseconds each month is shown for when an animated map plays
+MAP_FRAME_DURATION = 800
+
+OCCUPANCY_HOVER = (
+    '<b>%{text}</b><br>'
+    '<extra><br><br><b>%{z:.2f}%</b></extra>'
+    'Reported Occupancy: %{customdata[0]}<br>'
+    'Reported Capacity: %{customdata[1]}<br>'
+    'Capacity per 100k GP Registered Patients: %{customdata[2]}<br>'
+    'GP Registered Population: %{customdata[3]:,.0f}<br>')
+CAPACITY_HOVER = (
+    '<b>%{text}</b><br>'
+    '<extra><b><br><br>%{z}</b></extra>'
+    'Reported Occupancy: %{customdata[0]}<br>'
+    'Reported Capacity: %{customdata[1]}<br>'
+    'Occupancy Percent: %{customdata[2]} %<br>'
+    'GP Registered Population:</b> %{customdata[3]:,}<br>'
+)
+OCCUPANCY_CUSTOMDATA = ['Occupancy', 'Capacity', 'Capacity_100k', 'GP_Registered_Population']
+CAPACITY_CUSTOMDATA = ['Occupancy', 'Capacity', 'Occupancy_Percent', 'GP_Registered_Population']
+
+
+class FigureCache:
+    # process-wide LRU of serialized figure JSON, capped by total size, shared by every session
+
+    def __init__(self, max_bytes=FIGURE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._building = {}
+        self._lock = threading.Lock()
+
+    def lookup(self, key, build):
+        # the figure and whether it came from the cache, callers count hits with functions.count_cache
+        while True:
+            with self._lock:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    return pio.from_json(self._entries[key], skip_invalid=True), True
+
+                # only one caller builds a given figure, concurrent callers wait for its result
+                event = self._building.get(key)
+                if event is None:
+                    event = self._building[key] = threading.Event()
+                    break
+            event.wait()
+
+        try:
+            fig = build()
+            self._put(key, pio.to_json(fig, validate=False))
+            return fig, False
+        finally:
+            with self._lock:
+                del self._building[key]
+            event.set()
+
+    def _put(self, key, fig_json):
+        with self._lock:
+            self._entries[key] = fig_json
+            self.size += len(fig_json)
+            while self.size > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+figure_cache = FigureCache()
+
+
+def lookup_figure(name, key, build):
+    # key is (view, selected date, selected location, data version), name picks the figure within the view,
+    # returns the figure and whether it was a cache hit
+    return figure_cache.lookup((name,) + tuple(key), build)
+
+
+def _map_layout(fig, title):
+    fig.update_layout(
+        mapbox_style="carto-positron",
+        mapbox_zoom=5,
+        mapbox_center={"lat": 52.37, "lon": -0.5},
+        width=800,
+        height=600,
+        title=dict(text=title, font=dict(size=18, family='sans-serif')),
+        margin={"r": 0, "t": 30, "l": 0, "b": 0},
+        hoverlabel=dict(bgcolor="white", font_size=13, font_family="sans-serif")
+    )
+    return fig
+
+
+def occupancy_map(month_data, geojson_data, formatted_date):
+    fig = go.Figure(
+        go.Choroplethmapbox(
+            geojson=geojson_data,
+            locations=month_data['ICB23CD'],
+            featureidkey='properties.ICB23CD',
+            z=month_data['Occupancy_Percent'],
+            customdata=month_data[OCCUPANCY_CUSTOMDATA],
+            text=month_data['ICB23NMS'],
+            colorscale=plotly.colors.diverging.RdYlGn[::-1],
+            hovertemplate=OCCUPANCY_HOVER,
+            zmin=0,
+            zmax=100,
+        )
+    )
+    return _map_layout(fig, f"National Snapshot of Occupancy (% of Capacity) for {formatted_date}")
+
+
+def capacity_map(month_data, geojson_data, formatted_date):
+    fig = go.Figure(
+        go.Choroplethmapbox(
+            geojson=geojson_data,
+            locations=month_data['ICB23CD'],
+            featureidkey='properties.ICB23CD',
+            z=month_data['Capacity_100k'],
+            customdata=month_data[CAPACITY_CUSTOMDATA],
+            text=month_data['ICB23NMS'],
+            colorscale='RdYlGn',
+            zmin=0,
+            zmax=40,
+            hovertemplate=CAPACITY_HOVER
+        )
+    )
+    return _map_layout(fig, f"National Snapshot of Capacity (per 100K GP Registered Patients) for {formatted_date}")
+
+
+def _animated_map(frames, geojson_data, measure, customdata, title, **trace):
+    # geometry and styling go once in the base trace, each month's frame carries only its z, hover data and title
+    def month(i):
+        return go.Choroplethmapbox(z=frames[measure][i],
+                                   customdata=np.column_stack([frames[column][i] for column in customdata]))
+
+    latest = len(frames['labels']) - 1
+    base = month(latest).update(geojson=geojson_data, locations=frames['ICB23CD'],
+                                featureidkey='properties.ICB23CD', text=frames['ICB23NMS'], **trace)
+    fig = go.Figure(data=[base], frames=[
+        go.Frame(data=[month(i)], name=label, layout={'title': {'text': title.format(label)}})
+        for i, label in enumerate(frames['labels'])])
+    _map_layout(fig, title.format(frames['labels'][latest]))
+
+    # scrubbing and playing only swap frames in the browser, the server isn't involved
+    fig.update_layout(
+        height=680,
+        margin={"r": 0, "t": 30, "l": 0, "b": 80},
+        sliders=[dict(
+            active=latest,
+            currentvalue=dict(visible=False),
+            pad=dict(t=10),
+            steps=[dict(method='animate', label=label, args=[[label], dict(
+                mode='immediate', frame=dict(duration=0, redraw=True), transition=dict(duration=0))])
+                for label in frames['labels']])],
+        updatemenus=[dict(
+            type='buttons',
+            direction='left',
+            x=0, y=0, xanchor='right', yanchor='top',
+            pad=dict(t=10, r=10),
+            buttons=[
+                dict(label='Play', method='animate', args=[None, dict(
+                    frame=dict(duration=MAP_FRAME_DURATION, redraw=True), fromcurrent=True,
+                    transition=dict(duration=0))]),
+                dict(label='Pause', method='animate', args=[[None], dict(
+                    mode='immediate', frame=dict(duration=0, redraw=False))])])])
+    return fig
+
+
+def occupancy_map_animation(frames, geojson_data):
+    return _animated_map(frames, geojson_data, 'Occupancy_Percent', OCCUPANCY_CUSTOMDATA,
+                         "National Snapshot of Occupancy (% of Capacity) for {}",
+                         colorscale=plotly.colors.diverging.RdYlGn[::-1], zmin=0, zmax=100,
+                         hovertemplate=OCCUPANCY_HOVER)
+
+
+def capacity_map_animation(frames, geojson_data):
+    return _animated_map(frames, geojson_data, 'Capacity_100k', CAPACITY_CUSTOMDATA,
+                         "National Snapshot of Capacity (per 100K GP Registered Patients) for {}",
+                         colorscale='RdYlGn', zmin=0, zmax=40, hovertemplate=CAPACITY_HOVER)
+
+
+def time_series(series, traces, title, yaxis_title):
+    # traces is a list of (column, trace name) pairs plotted against the series dates
+    fig = go.Figure()
+    for column, name in traces:
+        fig.add_trace(
+            go.Scatter(
+                x=series['Date'],
+                y=series[column],
+                mode='lines+markers',
+                name=name,
+                customdata=series['Date'].dt.strftime('%B %Y')
+            )
+        )
+    fig.update_layout(
+        title=title,
+        xaxis_title='Date',
+        yaxis_title=yaxis_title,
+    )
+
+    # Update y-axis to 0 and remove display of day of the month from hoverboxes
+    fig.update_yaxes(rangemode='tozero')
+    fig.update_traces(hovertemplate='Date: %{customdata}<br>Value: %{y}')
+    return fig
+
+
+def occupancy_capacity_series(series, location):
+    return time_series(series, [('Occupancy', 'Occupancy'), ('Capacity', 'Capacity')],
+                       'Occupancy and Capacity Over Time for {}'.format(location), 'Value')
+
+
+def occupancy_percent_series(series, location):
+    return time_series(series, [('Occupancy_Percent', 'Occupancy')],
+                       'Occupancy % Over Time for {}'.format(location), 'Percent (%)')
+
+
+def capacity_100k_series(series, location):
+    return time_series(series, [('Capacity_100k', 'Capacity per 100K')],
+                       'Capacity per 100k GP Registered Patients Over Time for {}'.format(location),
+                       'Capacity per 100k')
+
+
+def gp_population_series(series, location):
+    return time_series(series, [('GP_Registered_Population', 'GP Registered Population')],
+                       'GP Registered Population for {}'.format(location), 'Population')
+
+
+def rolling_series(trends, measure, window, title, yaxis_title):
+    # a monthly measure with its trailing mean, from analytics.location_trends()
+    return time_series(trends, [(measure, 'Monthly'), (f'{measure}_rolling', f'{window}-Month Mean')],
+                       title, yaxis_title)
+
+
+def occupancy_percent_trend(trends, location, window):
+    return rolling_series(trends, 'Occupancy_Percent', window,
+                          'Occupancy % and {}-Month Mean for {}'.format(window, location), 'Percent (%)')
+
+
+def capacity_100k_trend(trends, location, window):
+    return rolling_series(trends, 'Capacity_100k', window,
+                          'Capacity per 100k and {}-Month Mean for {}'.format(window, location), 'Capacity per 100k')
+
+
+def occupancy_volatility_series(trends, location, window):
+    return time_series(trends, [('Volatility', 'Volatility')],
+                       'Occupancy % Volatility ({}-Month Standard Deviation) for {}'.format(window, location),
+                       'Percentage Points')
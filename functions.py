@@ -1,74 +1,303 @@
+import functools
+import hashlib
+import json
+import logging
+import multiprocessing
 import os
+import tempfile
+import threading
+import time
+import zipfile
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
 from datetime import datetime
-from dateutil.relativedelta import relativedelta
-import geopandas
+from urllib.parse import urljoin
 import numpy as np
 import pandas as pd
-import requests
-from bs4 import BeautifulSoup
-from openpyxl import load_workbook
 
 HEADER_KEYWORD = 'Region'
+SUMMARY_ROW_LABELS = ['ENGLAND', 'ENGLAND*']
+STREAM_COLUMNS = ['Region', 'Region_Code', 'ICB_Code', 'Name', 'Capacity', 'GP_Registered_Population', 'Occupancy']
+STREAM_BATCH_ROWS = 1000
 EXCEL_SHEET = 'Virtual Ward Data'
 FILE_PREFIX = 'VW'
 FILE_EXT = '.xlsx'
 LOCATION_DATA_FILE = './data/subICSLocations.csv'
 SHAPEFILE = './data/geodata/ICB_Shape.zip'
 GEOJSON_OUTPUT = './data/geodata/ICB2023.geojson'
+GEOJSON_TIER_OUTPUT = './data/geodata/ICB2023_{tier}.geojson'
+# simplification tolerance in metres and coordinate decimal places for each geometry tier
+GEOJSON_TIERS = {'full': (0, 6), 'medium': (250, 5), 'low': (1000, 4)}
+GEOJSON_DEFAULT_TIER = 'low'
+# bump when parsing, the location join or the dataset's columns and dtypes change, so month store entries,
+# the dataset cache and snapshots built by older code are rebuilt rather than reused
+PIPELINE_VERSION = 1
 DATA_PATH = './data'
+CACHE_PATH = './data/cache'
+DATASET_CACHE = f'./data/cache/vw_dataset.v{PIPELINE_VERSION}.parquet'
+MONTH_CACHE_PATH = './data/cache/months'
+MONTH_MANIFEST = './data/cache/months/manifest.json'
+SNAPSHOT_PATH = './data/snapshots'
+SNAPSHOT_LATEST = 'LATEST'
+SNAPSHOT_MANIFEST = 'manifest.json'
 DOWNLOAD_URL = 'https://www.england.nhs.uk/statistics/statistical-work-areas/virtual-ward/'
+DOWNLOAD_MANIFEST = './data/cache/downloads.json'
+DOWNLOAD_WORKERS = 4
+# worker processes for parsing workbooks, 0 uses every CPU this process may run on
+PARSE_WORKERS = int(os.environ.get('SITREP_PARSE_WORKERS', 0))
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+REQUEST_TIMEOUT = 60
+CUBE_MEASURES = ['Capacity', 'Occupancy', 'GP_Registered_Population']
+DERIVED_MEASURES = ['Capacity_100k', 'Occupancy_Percent']
+MOVER_LAGS = [1, 3, 6, 12]
+CATEGORY_COLUMNS = ['Region', 'ICB23CD', 'ICB23NM', 'ICB23NMS', 'NHSER23NM']
+MAP_FRAME_MONTHS = 24
+PIVOT_METRICS = ['Capacity', 'GP_Registered_Population', 'Occupancy', 'Occupancy_Percent']
+XLSX_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+XLSX_REL_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
 
+logger = logging.getLogger(__name__)
+# one JSON object per message, for stage timings and cache lookups
+metrics_logger = logging.getLogger(f'{__name__}.metrics')
+startup_timings = {}
+stage_stats = {}
+cache_stats = {}
+_stats_lock = threading.Lock()
+_content_hashes = {}
+# per-version caches shared by every session thread, each built once under its lock
+_cube_cache = {}
+_cube_lock = threading.Lock()
+_movers_cache = {}
+_movers_lock = threading.Lock()
+_pivot_cache = {}
+_pivot_lock = threading.Lock()
+
+
+@contextmanager
+def timed_stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        with _stats_lock:
+            # keep the first, cold, timing of each stage in this process
+            cold = name not in startup_timings
+            if cold:
+                startup_timings[name] = seconds
+            stats = stage_stats.setdefault(name, {'calls': 0, 'total': 0.0, 'max': 0.0, 'last': 0.0})
+            stats['calls'] += 1
+            stats['total'] += seconds
+            stats['max'] = max(stats['max'], seconds)
+            stats['last'] = seconds
+        metrics_logger.info(json.dumps({'event': 'stage', 'stage': name, 'seconds': round(seconds, 6), 'cold': cold,
+                                        'thread': threading.current_thread().name}))
+
+
+def count_cache(name, hit, count=1):
+    if not count:
+        return
+    with _stats_lock:
+        stats = cache_stats.setdefault(name, {'hits': 0, 'misses': 0})
+        stats['hits' if hit else 'misses'] += count
+    metrics_logger.info(json.dumps({'event': 'cache', 'cache': name, 'hit': hit, 'count': count,
+                                    'thread': threading.current_thread().name}))
+
+
+def stage_report():
+    # calls and seconds per stage in this process, with the cold first timing
+    with _stats_lock:
+        report = pd.DataFrame.from_dict({name: {**stats, 'cold': startup_timings[name]}
+                                         for name, stats in stage_stats.items()}, orient='index')
+    if report.empty:
+        return pd.DataFrame(columns=['calls', 'total', 'mean', 'max', 'last', 'cold'])
+    report.insert(2, 'mean', report['total'] / report['calls'])
+    return report.sort_values('total', ascending=False)
+
+
+def cache_report():
+    # hits and misses per cache, including the lru caches, which count their own
+    with _stats_lock:
+        report = {name: dict(stats) for name, stats in cache_stats.items()}
+    for name, cached in (('location index', _location_index), ('geometry', _load_geometry)):
+        info = cached.cache_info()
+        report[name] = {'hits': info.hits, 'misses': info.misses}
+    report = pd.DataFrame.from_dict(report, orient='index', columns=['hits', 'misses'])
+    report['hit_rate'] = report['hits'] / (report['hits'] + report['misses']).replace(0, np.nan)
+    return report
+
+
+def _xml_text(element):
+    return ''.join(text.text or '' for text in element.iter(f'{{{XLSX_NS}}}t'))
+
+
+def _sheet_paths(archive):
+    # map sheet names, in workbook order, to their xml part via the workbook relationships
+    workbook = ET.fromstring(archive.read('xl/workbook.xml'))
+    relationships = ET.fromstring(archive.read('xl/_rels/workbook.xml.rels'))
+    targets = {rel.get('Id'): rel.get('Target') for rel in relationships}
+    sheet_paths = {}
+    for sheet in workbook.iter(f'{{{XLSX_NS}}}sheet'):
+        target = targets[sheet.get(f'{{{XLSX_REL_NS}}}id')]
+        sheet_paths[sheet.get('name')] = target.lstrip('/') if target.startswith('/') else f'xl/{target}'
+    return sheet_paths
+
+
+def _shared_strings(archive):
+    if 'xl/sharedStrings.xml' not in archive.namelist():
+        return []
+    shared_strings = []
+    with archive.open('xl/sharedStrings.xml') as f:
+        for _, element in ET.iterparse(f):
+            if element.tag == f'{{{XLSX_NS}}}si':
+                shared_strings.append(_xml_text(element))
+                element.clear()
+    return shared_strings
+
+
+def _iter_sheet_cells(archive, sheet_path, shared_strings):
+    # stream cells as (reference, value) without building the sheet in memory
+    with archive.open(sheet_path) as f:
+        for _, element in ET.iterparse(f):
+            if element.tag != f'{{{XLSX_NS}}}c':
+                continue
+            cell_type = element.get('t')
+            value = element.find(f'{{{XLSX_NS}}}v')
+            if cell_type == 'inlineStr':
+                value = _xml_text(element)
+            elif value is not None:
+                value = shared_strings[int(value.text)] if cell_type == 's' else value.text
+            yield element.get('r'), value
+            element.clear()
+
+
+def probe_workbook(file_path, sheet_name=EXCEL_SHEET):
+    # read the reporting month (C6) and the header row number of a sheet straight from the xlsx xml,
+    # stopping as soon as the header row is found
+    probe = {'month': None, 'header_row': None}
+    with zipfile.ZipFile(file_path) as archive:
+        sheet_paths = _sheet_paths(archive)
+        shared_strings = _shared_strings(archive)
+        for cell_ref, value in _iter_sheet_cells(archive, sheet_paths[sheet_name], shared_strings):
+            if cell_ref == 'C6' and value:
+                probe['month'] = datetime.strptime(value.strip(), '%B %Y').strftime("%Y%m")
+            if isinstance(value, str) and HEADER_KEYWORD in value:
+                probe['header_row'] = int(cell_ref.lstrip('ABCDEFGHIJKLMNOPQRSTUVWXYZ'))
+                break
+    return probe
+
+
+def _read_report_date(file_path):
+    # the reporting month sits in C6 of the second sheet
+    with zipfile.ZipFile(file_path) as archive:
+        sheet_name = list(_sheet_paths(archive))[1]
+    month = probe_workbook(file_path, sheet_name)['month']
+    if month is None:
+        raise ValueError(f"No reporting month found in {file_path}")
+    return month
+
+
+def _conditional_headers(entry):
+    headers = {}
+    if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+
+def _download_report(session, file_url, entry):
+    # only send validators if the file they describe is still on disk
+    headers = _conditional_headers(entry) if entry and os.path.exists(entry['path']) else {}
+    with session.get(file_url, headers=headers, stream=True, timeout=REQUEST_TIMEOUT) as response:
+        if response.status_code == 304:
+            return entry, False
+        response.raise_for_status()
+
+        # stream the Excel file to a temp file of its own, outside the data directory load_data() scans
+        os.makedirs(CACHE_PATH, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(prefix='download-', suffix=FILE_EXT, dir=CACHE_PATH)
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+        validators = {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+
+    try:
+        # get net file name and path
+        new_file_path = f"{DATA_PATH}/VW{_read_report_date(temp_path)}.xlsx"
+        is_new = not os.path.exists(new_file_path)
+
+        # leave an identical existing report untouched so its mtime and cached month stay valid
+        if not is_new and _file_hash(new_file_path) == _file_hash(temp_path):
+            os.remove(temp_path)
+        else:
+            os.replace(temp_path, new_file_path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+    return {'path': new_file_path, **validators}, is_new
+
+
+def download_and_rename_files(url=DOWNLOAD_URL, workers=DOWNLOAD_WORKERS, progress=None):
+    # imported here as they are only needed for a refresh, which keeps app start-up fast
+    import requests
+    from bs4 import BeautifulSoup
+    from requests.adapters import HTTPAdapter
+
+    # create data directory if it does not exist
+    if not os.path.exists(DATA_PATH):
+        os.mkdir(DATA_PATH)
+
+    manifest = _read_manifest(DOWNLOAD_MANIFEST)
+    reports = manifest.setdefault('reports', {})
 
-def download_and_rename_files():
     with requests.Session() as session:
-        response = requests.get(DOWNLOAD_URL)
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        # an unchanged index page means there is nothing new to fetch, as long as every report it listed is on disk
+        index_entry = manifest.get('index', {})
+        reports_on_disk = all(os.path.exists(entry['path']) for entry in reports.values())
+        headers = _conditional_headers(index_entry) if index_entry.get('url') == url and reports_on_disk else {}
+        response = session.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+        if response.status_code == 304:
+            return 0, sum(os.path.exists(entry['path']) for entry in reports.values())
+        response.raise_for_status()
         soup = BeautifulSoup(response.text, "html.parser")
 
+        # find the links to the Excel files, skipping any URL or filename containing 'Time-Series'
+        file_urls = [urljoin(url, link['href']) for link in soup.select("a[href$='.xlsx']")]
+        file_urls = [file_url for file_url in dict.fromkeys(file_urls) if 'Time-Series' not in file_url]
+
         num_new_files_downloaded = 0
         total_files_downloaded = 0
+        # progress, if given, is called with (reports fetched, reports listed) as downloads complete
+        if progress:
+            progress(0, len(file_urls))
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = {file_url: executor.submit(_download_report, session, file_url, reports.get(file_url))
+                           for file_url in file_urls}
+                for file_url, future in futures.items():
+                    reports[file_url], is_new = future.result()
 
-        # create data directory if it does not exist
-        if not os.path.exists(DATA_PATH):
-            os.mkdir(DATA_PATH)
-
-        # find the links to the Excel files
-        for link in soup.select("a[href$='.xlsx']"):
-            file_url = link['href']
+                    # increment the counters after successful download and rename operation
+                    num_new_files_downloaded += is_new
+                    total_files_downloaded += 1
+                    if progress:
+                        progress(total_files_downloaded, len(file_urls))
 
-            # skip the file download if the URL or filename contains 'Time-Series'
-            if 'Time-Series' in file_url:
-                continue
-
-            # download the Excel file
-            response = requests.get(file_url)
-            with open("temp.xlsx", "wb") as f:
-                f.write(response.content)
-            try:
-                # load the workbook and get the date from the first sheet
-                wb = load_workbook('temp.xlsx')
-                sheet = wb.get_sheet_by_name(wb.get_sheet_names()[1])
-                date_in_sheet = sheet['C6'].value
-
-                # format date into YYYYMM
-                date_in_sheet = datetime.strptime(date_in_sheet, '%B %Y')
-
-                # reformat the datetime object to the format YYYYMM
-                workbook_formatted_date = date_in_sheet.strftime("%Y%m")
-
-                # get net file name and path
-                new_file_path = f"{DATA_PATH}/VW{workbook_formatted_date}.xlsx"
-                if os.path.exists(new_file_path):
-                    os.remove(new_file_path)
-                    num_new_files_downloaded += -1
-
-                # rename the file and move to downloaded directory
-                os.rename("temp.xlsx", new_file_path)
-
-                # increment the counter after successful download and rename operation
-                num_new_files_downloaded += 1
-                total_files_downloaded += 1
-            finally:
-                wb.close()
+            # only trust the index page validators once every report on it has been fetched
+            manifest['index'] = {
+                'url': url,
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified')}
+        finally:
+            _write_manifest(manifest, DOWNLOAD_MANIFEST)
 
         return num_new_files_downloaded, total_files_downloaded
 
@@ -81,51 +310,46 @@ def _clean_column_names(df):
     return df
 
 
-def load_data():
-    all_data = pd.DataFrame()
+def _find_header_index(df):
+    # find the index of the first row with a cell containing the keyword, checking a column at a time
+    matches = df.astype(str).apply(lambda col: col.str.contains(HEADER_KEYWORD, regex=False)).any(axis=1)
+    return matches[matches].index[0]
 
-    excel_files = [f for f in os.listdir(DATA_PATH) if f.startswith(FILE_PREFIX) and f.endswith(FILE_EXT)]
-    # Iterate through the Excel files and extract the relevant data
-    for file in excel_files:
-        file_path = os.path.join(DATA_PATH, file)
-        file_date = file.split(FILE_PREFIX)[1].split(FILE_EXT)[0]
-        df = pd.read_excel(file_path, sheet_name=EXCEL_SHEET)
 
-        # find the index of the row that contains the keyword
-        header_index = df[df.apply(lambda row: row.astype(str).str.contains(HEADER_KEYWORD).any(), axis=1)].index[0]
+def _read_sheet(file_path):
+    # probe the sheet xml for the header row so rows above the table are skipped
+    header_row = probe_workbook(file_path)['header_row']
+    if header_row is not None:
+        return pd.read_excel(file_path, sheet_name=EXCEL_SHEET, header=None, skiprows=header_row - 1)
 
-        # get the required table data
-        table_data = df.iloc[header_index:].copy()
-        table_data.columns = table_data.iloc[0]
-        table_data = table_data[1:]
-        table_data.rename_axis('Index', axis=1, inplace=True)
-        table_data['Date'] = file_date
+    df = pd.read_excel(file_path, sheet_name=EXCEL_SHEET)
+    return df.iloc[_find_header_index(df):]
 
-        # clean the data of summary rows
-        table_data = table_data[~(table_data == 'ENGLAND').any(axis=1)]
-        table_data = table_data[~(table_data == 'ENGLAND*').any(axis=1)]
 
-        # drop columns that are not required
-        cols_to_drop = [table_data.columns[i] for i in [0, 6, 9]]
-        table_data.drop(cols_to_drop, axis=1, inplace=True)
+def _clean_table(df, file_date):
+    # get the required table data
+    table_data = df.iloc[1:].copy()
+    table_data.columns = df.iloc[0]
+    table_data.rename_axis('Index', axis=1, inplace=True)
+    table_data['Date'] = file_date
 
-        # clean the column names to facilitate merging
-        table_data = _clean_column_names(table_data)
+    # clean the data of summary rows
+    table_data = table_data[~table_data.isin(SUMMARY_ROW_LABELS).any(axis=1)]
 
-        # append data to all_data dataframe
-        all_data = pd.concat([all_data, table_data])
-        all_data.dropna(axis=1, how='all', inplace=True)
+    # drop columns that are not required
+    cols_to_drop = [table_data.columns[i] for i in [0, 6, 9]]
+    table_data = table_data.drop(cols_to_drop, axis=1)
 
-    # get columns based in their index for renaming
-    cols = list(all_data.columns)
+    # clean the column names to facilitate merging
+    table_data = _clean_column_names(table_data)
+    table_data = table_data.dropna(axis=1, how='all')
 
-    # replace non-numeric values in numeric fields with NaN
-    all_data[cols[4]] = all_data[cols[4]].apply(safe_convert)
-    all_data[cols[5]] = all_data[cols[5]].apply(safe_convert)
-    all_data[cols[6]] = all_data[cols[6]].apply(safe_convert)
+    # get columns based in their index for renaming
+    cols = list(table_data.columns)
 
-    # set dtypes
-    all_data = all_data.astype({
+    # replace non-numeric values in numeric fields with NaN and set dtypes, a whole column at a time
+    table_data[cols[4:7]] = table_data[cols[4:7]].apply(pd.to_numeric, errors='coerce')
+    table_data = table_data.astype({
         cols[0]: 'object',
         cols[1]: 'object',
         cols[2]: 'object',
@@ -146,10 +370,233 @@ def load_data():
         cols[5]: 'GP_Registered_Population',
         cols[6]: 'Occupancy',
         cols[7]: 'Date'}
-    all_data.rename(columns=rename_dict, inplace=True)
-    # Set date field format and correct data
+    table_data.rename(columns=rename_dict, inplace=True)
+    return table_data
+
+
+def _parse_workbook(file_path, file_date):
+    return _clean_table(_read_sheet(file_path), file_date)
+
+
+def _file_hash(file_path):
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _read_manifest(manifest_file):
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file) as f:
+        return json.load(f)
+
+
+def _write_manifest(manifest, manifest_file):
+    os.makedirs(os.path.dirname(manifest_file), exist_ok=True)
+    temp_file = f"{manifest_file}.{os.getpid()}.tmp"
+    with open(temp_file, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(temp_file, manifest_file)
+
+
+def _file_date(file):
+    return file.split(FILE_PREFIX)[1].split(FILE_EXT)[0]
+
+
+def _month_file(file):
+    return os.path.join(MONTH_CACHE_PATH, file.replace(FILE_EXT, '.parquet'))
+
+
+def _read_cached_month(file, manifest):
+    file_path = os.path.join(DATA_PATH, file)
+    month_file = _month_file(file)
+    entry = manifest.get(file)
+    if not entry or entry.get('pipeline') != PIPELINE_VERSION or not os.path.exists(month_file):
+        return None
+
+    # reuse the processed month if the workbook is untouched, or was re-downloaded with the same content
+    file_mtime = os.path.getmtime(file_path)
+    if entry['mtime'] == file_mtime or entry['sha256'] == _file_hash(file_path):
+        entry['mtime'] = file_mtime
+        return pd.read_parquet(month_file)
+    return None
+
+
+def _available_cpus():
+    # CPUs this process is allowed to run on, which a container can limit below the host's count
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def _map_workbooks(func, jobs, workers=None):
+    if workers is None:
+        workers = PARSE_WORKERS or _available_cpus()
+    workers = min(workers, len(jobs))
+
+    # handle each month's sheet in its own process, falling back to serial if a pool can't be used
+    if workers > 1:
+        executor = None
+        try:
+            # forkserver workers start clean rather than as forks of a threaded server process
+            executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver'))
+            # workers are started as jobs are submitted, so a pool that can't start fails here
+            futures = [executor.submit(func, *job) for job in jobs]
+        except (OSError, ValueError, BrokenProcessPool):
+            if executor:
+                executor.shutdown(cancel_futures=True)
+        else:
+            with executor:
+                try:
+                    # a job's own error is raised as it is, only a pool that breaks falls back to serial
+                    return [future.result() for future in futures]
+                except BrokenProcessPool:
+                    pass
+    return [func(*job) for job in jobs]
+
+
+def _parse_workbooks(files, workers=None):
+    jobs = [(os.path.join(DATA_PATH, file), _file_date(file)) for file in files]
+    return _map_workbooks(_parse_workbook, jobs, workers)
+
+
+def iter_sheet_rows(file_path, sheet_name=EXCEL_SHEET):
+    # stream a sheet's rows as tuples of values with openpyxl's read-only row iterator
+    from openpyxl import load_workbook
+
+    wb = load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        yield from wb[sheet_name].iter_rows(values_only=True)
+    finally:
+        wb.close()
+
+
+def _record_batch(columns, rows, file_date):
+    # type one batch of sheet rows into the month store schema
+    import pyarrow as pa
+
+    # rows can be shorter than the header when a sheet has no dimensions recorded, pad them to the last column
+    width = max(columns) + 1
+    rows = [tuple(row) + (None,) * (width - len(row)) for row in rows
+            if not any(value in SUMMARY_ROW_LABELS for value in row)]
+    values = list(zip(*rows)) if rows else [()] * width
+    arrays = []
+    for name, i in zip(STREAM_COLUMNS, columns):
+        if name in CUBE_MEASURES:
+            arrays.append(pa.array(pd.to_numeric(pd.Series(values[i], dtype=object), errors='coerce').astype('Int64')))
+        else:
+            arrays.append(pa.array([value if value is None or isinstance(value, str) else str(value)
+                                    for value in values[i]], type=pa.string()))
+    arrays.append(pa.array([file_date] * len(rows), type=pa.string()))
+    return pa.RecordBatch.from_arrays(arrays, schema=_stream_schema())
+
+
+@functools.lru_cache(maxsize=None)
+def _stream_schema():
+    # same schema and pandas metadata as a month written from a parsed table, so measures read back as Int64
+    import pyarrow as pa
+
+    sample = pd.DataFrame({name: pd.array([0], dtype='Int64') if name in CUBE_MEASURES else ['']
+                           for name in STREAM_COLUMNS + ['Date']})
+    return pa.Schema.from_pandas(sample, preserve_index=False)
+
+
+def iter_record_batches(file_path, file_date, batch_rows=STREAM_BATCH_ROWS):
+    rows = iter_sheet_rows(file_path)
+    for header in rows:
+        if any(isinstance(value, str) and HEADER_KEYWORD in value for value in header):
+            break
+    else:
+        raise ValueError(f"No header row containing '{HEADER_KEYWORD}' in {file_path}")
+
+    # keep the named columns, less the blank first column and the derived per 100k and occupancy % columns
+    columns = [i for i, name in enumerate(header) if name is not None and i not in (0, 6, 9)]
+    if len(columns) < len(STREAM_COLUMNS):
+        raise ValueError(f"Expected {len(STREAM_COLUMNS)} columns after the header in {file_path}, found {len(columns)}")
+    columns = columns[:len(STREAM_COLUMNS)]
+
+    batch = []
+    blank_rows = []
+    for row in rows:
+        # hold back empty rows until more data follows, read_excel keeps blank rows inside a table but not after it
+        if all(value is None for value in row):
+            blank_rows.append(row)
+            continue
+        batch += blank_rows + [row]
+        blank_rows = []
+        if len(batch) >= batch_rows:
+            yield _record_batch(columns, batch, file_date)
+            batch = []
+    if batch:
+        yield _record_batch(columns, batch, file_date)
+
+
+def _stream_workbook(file_path, file_date, month_file):
+    # write a month straight into the columnar store so peak memory is one batch, not one sheet
+    import pyarrow.parquet as pq
+
+    os.makedirs(os.path.dirname(month_file), exist_ok=True)
+    temp_file = f"{month_file}.{os.getpid()}.tmp"
+    rows = 0
+    with pq.ParquetWriter(temp_file, _stream_schema()) as writer:
+        for batch in iter_record_batches(file_path, file_date):
+            writer.write_batch(batch)
+            rows += batch.num_rows
+    os.replace(temp_file, month_file)
+    return rows
+
+
+def load_data(incremental=True, workers=None, streaming=False):
+    # sorted file names are in date order, which keeps the output deterministic
+    excel_files = sorted(f for f in os.listdir(DATA_PATH) if f.startswith(FILE_PREFIX) and f.endswith(FILE_EXT))
+
+    # Iterate through the Excel files and extract the relevant data, parsing only new or changed months
+    if incremental or streaming:
+        manifest = _read_manifest(MONTH_MANIFEST) if incremental else {}
+        with timed_stage('read month store'):
+            months = {file: _read_cached_month(file, manifest) for file in excel_files}
+        stale_files = [file for file, table_data in months.items() if table_data is None]
+        count_cache('month store', True, len(excel_files) - len(stale_files))
+        count_cache('month store', False, len(stale_files))
+
+        if streaming:
+            jobs = [(os.path.join(DATA_PATH, file), _file_date(file), _month_file(file)) for file in stale_files]
+            with timed_stage('stream workbooks'):
+                row_counts = _map_workbooks(_stream_workbook, jobs, workers)
+        else:
+            with timed_stage('parse workbooks'):
+                parsed = _parse_workbooks(stale_files, workers)
+            for file, table_data in zip(stale_files, parsed):
+                _write_cache(table_data, _month_file(file))
+                months[file] = table_data
+            row_counts = [len(table_data) for table_data in parsed]
+
+        for file, rows in zip(stale_files, row_counts):
+            file_path = os.path.join(DATA_PATH, file)
+            manifest[file] = {'mtime': os.path.getmtime(file_path), 'sha256': _file_hash(file_path), 'rows': rows,
+                              'pipeline': PIPELINE_VERSION}
+            if months[file] is None:
+                months[file] = pd.read_parquet(_month_file(file))
+
+        # forget months whose workbook has been removed
+        for file in set(manifest) - set(excel_files):
+            if os.path.exists(_month_file(file)):
+                os.remove(_month_file(file))
+            del manifest[file]
+        _write_manifest(manifest, MONTH_MANIFEST)
+        months = [months[file] for file in excel_files]
+    else:
+        with timed_stage('parse workbooks'):
+            months = _parse_workbooks(excel_files, workers)
+
+    # assemble all months with a single concat
+    all_data = pd.concat(months)
+    all_data.dropna(axis=1, how='all', inplace=True)
+
+    # Set date field format, YYYYMM parses to the first of the month
     all_data['Date'] = pd.to_datetime(all_data['Date'], format='%Y%m')
-    all_data['Date'] = all_data['Date'].apply(lambda date: date.replace(day=1))
 
     # Add 'Occupancy_Percent' with new calculated field
     all_data['Occupancy_Percent'] = all_data['Occupancy'] / all_data['Capacity'].replace(0, np.nan)
@@ -159,82 +606,455 @@ def load_data():
     return all_data
 
 
-def get_vw_dataset():
-    vw_data = load_data()
-    # clean whitespace data
-    vw_data = vw_data.apply(lambda x: x.str.strip() if x.dtype == 'object' else x)
+def _source_files():
+    excel_files = sorted(f for f in os.listdir(DATA_PATH) if f.startswith(FILE_PREFIX) and f.endswith(FILE_EXT))
+    return [os.path.join(DATA_PATH, f) for f in excel_files] + [LOCATION_DATA_FILE]
+
+
+def _cache_is_fresh(cache_file, source_files):
+    if not os.path.exists(cache_file):
+        return False
+    cache_mtime = os.path.getmtime(cache_file)
+    # the data directory mtime changes when a workbook is added or removed
+    return all(os.path.getmtime(f) < cache_mtime for f in source_files + [DATA_PATH])
+
+
+def _write_cache(df, cache_file):
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    # write to a temp file and swap so readers never see a partial file
+    temp_file = f"{cache_file}.{os.getpid()}.tmp"
+    df.to_parquet(temp_file, index=False)
+    os.replace(temp_file, cache_file)
+
+
+def _narrow_int(series):
+    # smallest nullable integer type that holds the column's range, signed so differences can't wrap
+    values = series.dropna()
+    for dtype in ('Int8', 'Int16', 'Int32'):
+        info = np.iinfo(dtype.lower())
+        if values.empty or (values.min() >= info.min and values.max() <= info.max):
+            return series.astype(dtype)
+    return series.astype('Int64')
+
+
+def compact_dtypes(df):
+    # categorical codes for the repeated name and code columns, narrow counts and float32 ratios
+    df = df.copy()
+    for column in CATEGORY_COLUMNS:
+        if column in df and not isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype('category')
+    for measure in CUBE_MEASURES:
+        if measure in df:
+            df[measure] = _narrow_int(df[measure])
+    for measure in DERIVED_MEASURES:
+        if measure in df:
+            df[measure] = df[measure].astype('float32')
+    return df
+
+
+def memory_report(df):
+    # bytes held by each column, including the strings behind object columns
+    usage = df.memory_usage(index=False, deep=True)
+    return pd.DataFrame({'Dtype': df.dtypes.astype(str), 'Bytes': usage, 'Percent': usage / usage.sum() * 100})
+
+
+def get_vw_dataset(use_cache=True, workers=None):
+    # load the cleaned, merged dataset from the parquet cache when it is newer than every source file
+    fresh = use_cache and _cache_is_fresh(DATASET_CACHE, _source_files())
+    count_cache('dataset', fresh, int(use_cache))
+    if fresh:
+        with timed_stage('read dataset cache'):
+            return compact_dtypes(pd.read_parquet(DATASET_CACHE))
+
+    # otherwise start from a prebuilt snapshot of the same source files, if one exists
+    snapshot = latest_snapshot() if use_cache else None
+    matched = bool(snapshot) and snapshot['version'] == get_data_version()
+    count_cache('snapshot', matched, int(use_cache))
+    if matched:
+        with timed_stage('read snapshot'):
+            merged_df = compact_dtypes(read_snapshot(snapshot))
+        _write_cache(merged_df, DATASET_CACHE)
+        return merged_df
+
+    with timed_stage('build_vw_dataset'):
+        merged_df = build_vw_dataset(workers)
+    if use_cache:
+        _write_cache(merged_df, DATASET_CACHE)
+    return merged_df
+
+
+def latest_snapshot(snapshot_path=SNAPSHOT_PATH):
+    # manifest of the snapshot named in the LATEST pointer written by snapshot.py
+    latest_file = os.path.join(snapshot_path, SNAPSHOT_LATEST)
+    if not os.path.exists(latest_file):
+        return None
+    with open(latest_file) as f:
+        snapshot_dir = os.path.join(snapshot_path, f.read().strip())
+    manifest = _read_manifest(os.path.join(snapshot_dir, SNAPSHOT_MANIFEST))
+    return {**manifest, 'path': snapshot_dir} if manifest else None
+
 
-    # merge vw_data and icb location data using temp fields for case insensitivity
-    ics_data = pd.read_csv(LOCATION_DATA_FILE)
+def read_snapshot(snapshot, artifact='vw_dataset.parquet'):
+    artifact_file = os.path.join(snapshot['path'], artifact)
+    if artifact.endswith('.parquet'):
+        return pd.read_parquet(artifact_file)
+    if artifact.endswith('.csv'):
+        return pd.read_csv(artifact_file)
+    with open(artifact_file) as f:
+        return json.load(f)
 
-    vw_data['temp_name'] = vw_data['Name'].str.lower()
-    ics_data['temp_location'] = ics_data['ICB_Name'].str.lower()
-    merged_df = pd.merge(left=vw_data, right=ics_data, left_on='temp_name', right_on='temp_location', how='left')
 
-    # remove temporary columns
-    del merged_df['temp_name']
-    del merged_df['temp_location']
+def _normalize_names(names):
+    # case, spacing and footnote markers vary between months, e.g. 'NHS Northamptonshire Integrated Care Board*'
+    return names.str.strip().str.rstrip('*').str.strip().str.lower().str.replace(r'\s+', ' ', regex=True)
 
-    # group and aggregate fields
-    merged_df = merged_df.groupby(['Date', 'ICB23CD']).agg({
-        'Capacity': 'sum',
-        'GP_Registered_Population': 'sum',
-        'Occupancy': 'sum',
-        'ICB23NM': 'first',
-        'NHSER23NM': 'first',
-    }).reset_index()
+
+@functools.lru_cache(maxsize=1)
+def _location_index(location_file, mtime):
+    ics_data = pd.read_csv(location_file, encoding='utf-8-sig').sort_values('ICB23CD', ignore_index=True)
+    positions = pd.Series(ics_data.index, dtype='Int64')
+    return {
+        'ICB23CD': ics_data['ICB23CD'].to_numpy(),
+        'ICB23NM': ics_data['ICB23NM'].to_numpy(),
+        'NHSER23NM': ics_data['NHSER23NM'].to_numpy(),
+        # construct ICB23NMS which has shortened Integrated Care Board to ICB
+        'ICB23NMS': (ics_data['ICB23NM'].str.slice(0, -21) + 'ICB').to_numpy(),
+        'codes': dict(zip(ics_data['ICB23CD'].str.upper(), positions)),
+        'names': dict(zip(_normalize_names(ics_data['ICB_Name']), positions)),
+    }
+
+
+def load_location_index(location_file=LOCATION_DATA_FILE):
+    # ICB lookup arrays sorted by ICB23CD with code and normalized name indexes, rebuilt only when the file changes
+    return _location_index(location_file, os.path.getmtime(location_file))
+
+
+def match_locations(vw_data, index):
+    # position of each row in the location index, by code where the sheet gives one and by name otherwise
+    codes = vw_data['ICB_Code'].str.strip().str.upper()
+    by_name = _normalize_names(vw_data['Name']).map(index['names'])
+
+    # sheets give ODS codes, which the location file lacks, so learn them from the rows matched by name
+    learned = pd.Series(by_name.to_numpy(), index=codes).dropna()
+    learned = learned[learned.index.notna()]
+
+    # a code seen against more than one ICB is not learned, its rows fall back to their names
+    ambiguous = learned.groupby(level=0).nunique()
+    ambiguous = ambiguous.index[ambiguous > 1]
+    if len(ambiguous):
+        logger.warning("ICB code(s) matched more than one ICB by name and were not used: %s", ', '.join(
+            f"{code} -> {', '.join(index['ICB23CD'][learned[[code]].unique().astype(int)])}" for code in ambiguous))
+    learned = learned[~learned.index.isin(ambiguous) & ~learned.index.duplicated()]
+
+    positions = codes.map(index['codes']).fillna(codes.map(learned)).fillna(by_name)
+    return positions.astype('Int64')
+
+
+def build_vw_dataset(workers=None):
+    vw_data = load_data(workers=workers)
+
+    # footnotes and blank rows carry neither a code nor a name
+    vw_data = vw_data.dropna(subset=['ICB_Code', 'Name'], how='all')
+
+    with timed_stage('location join'):
+        index = load_location_index()
+        positions = match_locations(vw_data, index)
+    unmatched = vw_data[positions.isna()]
+    if len(unmatched):
+        logger.warning("%d row(s) matched no ICB in %s and were dropped:\n%s", len(unmatched), LOCATION_DATA_FILE,
+                       unmatched[['Date', 'Region', 'ICB_Code', 'Name']].to_string(index=False))
+
+    # group and aggregate fields by position, which is in ICB23CD order
+    measures = vw_data[['Capacity', 'GP_Registered_Population', 'Occupancy']].rename_axis(columns=None)
+    with timed_stage('aggregate'):
+        merged_df = measures.groupby([vw_data['Date'], positions.rename('position')]).sum().reset_index()
+    position = merged_df.pop('position').to_numpy(dtype=int)
+    merged_df.insert(1, 'ICB23CD', index['ICB23CD'][position])
+    merged_df['ICB23NM'] = index['ICB23NM'][position]
+    merged_df['NHSER23NM'] = index['NHSER23NM'][position]
 
     # replace calculated fields
     merged_df['Capacity_100k'] = (
             merged_df['Capacity'] / merged_df['GP_Registered_Population'].replace(0, np.nan) * 100000).round(2)
     merged_df['Occupancy_Percent'] = (merged_df['Occupancy'] / merged_df['Capacity'].replace(0, np.nan) * 100).round(2)
+    merged_df['ICB23NMS'] = index['ICB23NMS'][position]
 
-    # construct ICB23NMS which has shortened Integrated Care Board to ICB
-    merged_df['ICB23NMS'] = merged_df['ICB23NM'].str.slice(0, -21) + 'ICB'
+    return compact_dtypes(merged_df)
+
+
+def _content_hash(file_path):
+    # sha256 of a source file, rehashed only when its mtime or size changes
+    stat = os.stat(file_path)
+    key = (stat.st_mtime_ns, stat.st_size)
+    cached = _content_hashes.get(file_path)
+    if cached and cached[0] == key:
+        return cached[1]
+
+    # the month store already holds a hash of each workbook it has parsed
+    entry = _read_manifest(MONTH_MANIFEST).get(os.path.basename(file_path))
+    if entry and entry['mtime'] == os.path.getmtime(file_path):
+        sha256 = entry['sha256']
+    else:
+        sha256 = _file_hash(file_path)
+    _content_hashes[file_path] = (key, sha256)
+    return sha256
+
+
+def get_data_version():
+    # token identifying the contents of the source files, so a snapshot still matches after a checkout or copy,
+    # and the pipeline that reads them, so one built by older code doesn't
+    sha = hashlib.sha1(f"pipeline:{PIPELINE_VERSION};".encode())
+    for file_path in _source_files():
+        sha.update(f"{os.path.basename(file_path)}:{_content_hash(file_path)};".encode())
+    return sha.hexdigest()[:12]
+
+
+def _ratio(numerator, denominator, scale):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.round(numerator / np.where(denominator == 0, np.nan, denominator) * scale, 2)
 
-    return merged_df
 
+def _add_derived_measures(arrays):
+    arrays['Capacity_100k'] = _ratio(arrays['Capacity'], arrays['GP_Registered_Population'], 100000)
+    arrays['Occupancy_Percent'] = _ratio(arrays['Occupancy'], arrays['Capacity'], 100)
+    return arrays
+
+
+def build_cube(df):
+    # dense (month, ICB) arrays of each measure, with NaN where an ICB has no row for a month
+    dates = pd.DatetimeIndex(np.sort(df['Date'].unique()))
+    icbs = df.drop_duplicates('ICB23CD').sort_values('ICB23CD')[['ICB23CD', 'ICB23NMS', 'NHSER23NM']]
+    icb_codes = icbs['ICB23CD'].to_numpy()
+    month_idx = dates.searchsorted(df['Date'])
+    icb_idx = np.searchsorted(icb_codes, df['ICB23CD'])
+
+    present = np.zeros((len(dates), len(icb_codes)), dtype=bool)
+    present[month_idx, icb_idx] = True
+    icb = {}
+    for measure in CUBE_MEASURES:
+        values = np.full(present.shape, np.nan)
+        values[month_idx, icb_idx] = df[measure].to_numpy(dtype=float, na_value=np.nan)
+        icb[measure] = values
+    _add_derived_measures(icb)
+
+    # national and region rollups of the base measures, with ratios recomputed from the totals
+    regions, region_idx = np.unique(icbs['NHSER23NM'].astype(object).fillna('Unknown').to_numpy(dtype=str),
+                                    return_inverse=True)
+    region_membership = np.eye(len(regions))[region_idx]
+    national = _add_derived_measures({measure: np.nansum(icb[measure], axis=1) for measure in CUBE_MEASURES})
+    region = _add_derived_measures({measure: np.nan_to_num(icb[measure]) @ region_membership
+                                    for measure in CUBE_MEASURES})
+
+    return {
+        'dates': dates,
+        'date_index': {(date.year, date.month): i for i, date in enumerate(dates)},
+        'icb_codes': icb_codes,
+        'icb_names': icbs['ICB23NMS'].to_numpy(),
+        'icb_regions': icbs['NHSER23NM'].to_numpy(),
+        'name_index': {name: i for i, name in enumerate(icbs['ICB23NMS'])},
+        'regions': regions,
+        'present': present,
+        'icb': icb,
+        'national': national,
+        'region': region,
+        'version': None,
+    }
+
+
+def get_cube(df, version=None):
+    # build the cube once per data version and reuse it across reruns
+    version = version or get_data_version()
+    with _cube_lock:
+        cube = _cube_cache.get(version)
+        count_cache('cube', cube is not None)
+        if cube is None:
+            _cube_cache.clear()
+            with timed_stage('build_cube'):
+                cube = _cube_cache[version] = build_cube(df)
+            cube['version'] = version
+    return cube
+
+
+def cube_month_slice(cube, year, month):
+    # one row per reporting ICB for a month, in the shape the choropleth maps expect
+    i = cube['date_index'][(year, month)]
+    present = cube['present'][i]
+    month_data = pd.DataFrame({measure: values[i, present] for measure, values in cube['icb'].items()})
+    month_data.insert(0, 'ICB23CD', cube['icb_codes'][present])
+    month_data['ICB23NMS'] = cube['icb_names'][present]
+    return month_data
+
+
+def cube_map_frames(cube, months=MAP_FRAME_MONTHS):
+    # every measure for every ICB over the latest months, NaN where an ICB didn't report, for animated maps
+    rows = slice(max(len(cube['dates']) - months, 0), None)
+    dates = cube['dates'][rows]
+    return {
+        'dates': dates,
+        'labels': [date.strftime('%B %Y') for date in dates],
+        'ICB23CD': cube['icb_codes'],
+        'ICB23NMS': cube['icb_names'],
+        **{measure: values[rows] for measure, values in cube['icb'].items()},
+    }
+
+
+def cube_location_series(cube, location='National'):
+    # monthly totals for the whole country, a region, or a single ICB by short name
+    if location == 'National':
+        values, months = cube['national'], slice(None)
+    elif location in cube['name_index']:
+        j = cube['name_index'][location]
+        values = {measure: series[:, j] for measure, series in cube['icb'].items()}
+        months = cube['present'][:, j]
+    else:
+        j = int(np.flatnonzero(cube['regions'] == location)[0])
+        values = {measure: series[:, j] for measure, series in cube['region'].items()}
+        months = slice(None)
+
+    series = pd.DataFrame({measure: values[measure][months] for measure in CUBE_MEASURES + DERIVED_MEASURES})
+    series.insert(0, 'Date', cube['dates'][months])
+    return series
+
+
+def build_pivot(cube):
+    # (location, metric) x month table for every ICB plus the national totals, newest month first
+    names = np.concatenate([['National'], cube['icb_names']])
+    order = np.argsort(names[1:], kind='stable') + 1
+    names = names[np.concatenate([[0], order])]
+    values = np.stack([np.column_stack([cube['national'][metric], cube['icb'][metric][:, order - 1]])
+                       for metric in PIVOT_METRICS], axis=1)
+
+    # values is (month, metric, location), flatten to rows of location-major (location, metric) pairs
+    rows = values.transpose(2, 1, 0).reshape(len(names) * len(PIVOT_METRICS), len(cube['dates']))
+    index = pd.MultiIndex.from_product([names, PIVOT_METRICS], names=['ICB23NMS', 'Metric'])
+    return pd.DataFrame(rows, index=index, columns=cube['dates']).iloc[:, ::-1]
+
+
+def get_pivot(cube):
+    version = cube.get('version')
+    if version is None:
+        return build_pivot(cube)
+    with _pivot_lock:
+        pivot = _pivot_cache.get(version)
+        count_cache('pivot', pivot is not None)
+        if pivot is None:
+            _pivot_cache.clear()
+            with timed_stage('build_pivot'):
+                pivot = _pivot_cache[version] = build_pivot(cube)
+    return pivot
+
+
+def _simplify(geometry, tolerance):
+    import geopandas
+    import shapely
+
+    if tolerance == 0:
+        return geometry
+    # simplify shared boundaries once as a coverage so neighbouring ICBs stay gap free, where shapely supports it
+    if hasattr(shapely, 'coverage_simplify'):
+        return geopandas.GeoSeries(shapely.coverage_simplify(geometry.values, tolerance),
+                                   index=geometry.index, crs=geometry.crs)
+    return geometry.simplify(tolerance, preserve_topology=True)
+
+
+def convert_shape_to_json(tiers=GEOJSON_TIERS):
+    # imported here as the geometry build only runs when the geojson files are missing
+    import geopandas
+    import shapely
 
-def convert_shape_to_json():
     shape_data = geopandas.read_file(SHAPEFILE)
-    shape_data.to_crs(epsg=4326, inplace=True)
-    shape_data.to_file(GEOJSON_OUTPUT, driver='GeoJSON')
-    return GEOJSON_OUTPUT
+    shape_data.to_crs(epsg=4326).to_file(GEOJSON_OUTPUT, driver='GeoJSON')
 
+    # write compact tiers, simplified in British National Grid metres and keeping only the join key
+    shape_data = shape_data[['ICB23CD', 'geometry']]
+    tier_files = {}
+    for tier, (tolerance, precision) in tiers.items():
+        tier_data = shape_data.set_geometry(_simplify(shape_data.geometry, tolerance)).to_crs(epsg=4326)
+        # snap to the tier's decimal places on a grid that keeps every ring valid, rather than rounding coordinates
+        tier_data.geometry = shapely.set_precision(tier_data.geometry.values, 10 ** -precision)
+        tier_files[tier] = GEOJSON_TIER_OUTPUT.format(tier=tier)
+        with open(tier_files[tier], 'w') as geo_file:
+            json.dump(tier_data.to_geo_dict(drop_id=True), geo_file, separators=(',', ':'))
+    return tier_files
+
+
+def load_geometry(tier=None):
+    # one parsed geometry object per tier, shared by every map that draws it, whichever way the tier is asked for
+    return _load_geometry(tier or GEOJSON_DEFAULT_TIER)
+
+
+@functools.lru_cache(maxsize=None)
+def _load_geometry(tier):
+    geojson_file = GEOJSON_TIER_OUTPUT.format(tier=tier)
+    if not os.path.exists(geojson_file):
+        with timed_stage('convert_shape_to_json'):
+            convert_shape_to_json()
+    with timed_stage(f'load_geometry {tier}'), open(geojson_file) as geo_file:
+        return json.load(geo_file)
+
+
+def compute_movers(cube, features=None, lags=MOVER_LAGS):
+    # month-over-month and N-month deltas for every feature, month and ICB in one pass over the cube
+    features = features or CUBE_MEASURES + DERIVED_MEASURES
+    values = np.stack([cube['icb'][feature] for feature in features])
+    periods = cube['dates'].year * 12 + cube['dates'].month - 1
+
+    movers = {}
+    for lag in lags:
+        # index of the month `lag` months earlier, which may be missing from the history
+        prev_idx = np.searchsorted(periods, periods - lag)
+        has_prev = (prev_idx < len(periods)) & (periods[np.minimum(prev_idx, len(periods) - 1)] == periods - lag)
+        previous = np.full(values.shape, np.nan)
+        previous[:, has_prev] = values[:, prev_idx[has_prev]]
+
+        increase = values - previous
+        with np.errstate(divide='ignore', invalid='ignore'):
+            percent = np.round(increase / previous * 100, 2)
+        for i, feature in enumerate(features):
+            movers[(feature, lag)] = {
+                'previous': previous[i],
+                'current': values[i],
+                'increase': increase[i],
+                'percent': percent[i],
+            }
+    return movers
+
+
+def get_movers(cube):
+    # movers are cached alongside the cube for its data version
+    version = cube.get('version')
+    if version is None:
+        return compute_movers(cube)
+    with _movers_lock:
+        movers = _movers_cache.get(version)
+        count_cache('movers', movers is not None)
+        if movers is None:
+            _movers_cache.clear()
+            with timed_stage('compute_movers'):
+                movers = _movers_cache[version] = compute_movers(cube)
+    return movers
+
+
+def top_movers(cube, year, month, feature, lag=1, top_x=5, rising=True, region=None):
+    # top ICBs by change in a feature against `lag` months earlier, as numeric columns
+    mover = get_movers(cube)[(feature, lag)]
+    i = cube['date_index'][(year, month)]
+    icbs = np.ones(len(cube['icb_codes']), dtype=bool) if region is None else cube['icb_regions'] == region
 
-def calculate_topn(df, year, month, months_back, feature, top_x):
-    # Convert the year and month to a datetime
-    selected_date = datetime(year=year, month=month, day=1)
-    # Calculate the date months_back months ago
-    prev_date = selected_date - relativedelta(months=months_back)
-    prev_month = prev_date.month
-    prev_year = prev_date.year
-    # Filter data for the selected month and the month months_back months ago
-    selected_month_data = df[(df['Date'].dt.year == year) &
-                             (df['Date'].dt.month == month)]
-    prev_month_data = df[(df['Date'].dt.year == prev_year) &
-                         (df['Date'].dt.month == prev_month)]
-    # Calculate the total value of the feature for each month for each ICS
-    selected_month_value = selected_month_data.groupby('ICB23NMS')[feature].sum()
-    prev_month_value = prev_month_data.groupby('ICB23NMS')[feature].sum()
-    # Calculate the difference in the feature value between the two months for each ICS
-    value_increase = selected_month_value - prev_month_value
-    # Calculate the increase percentage
-    value_increase_percent = round(value_increase / prev_month_value * 100, 2)
-    # Compute previous, current, and the difference in a DataFrame
     value_df = pd.DataFrame({
-        f'Previous {feature}': prev_month_value,
-        f'Current {feature}': selected_month_value,
-        'Increase': value_increase,
-        'Percentage Increase': value_increase_percent.apply('{:,.2f}'.format) + "%"
-    })
-    # Only retain the top X increased ICSs
-    top_ics_df = value_df.nlargest(top_x, 'Increase')
-    return top_ics_df
+        f'Previous {feature}': mover['previous'][i, icbs],
+        f'Current {feature}': mover['current'][i, icbs],
+        'Increase': mover['increase'][i, icbs],
+        'Percentage Increase': mover['percent'][i, icbs],
+    }, index=pd.Index(cube['icb_names'][icbs], name='ICB23NMS')).dropna(subset=['Increase']).sort_index()
 
+    if rising:
+        return value_df.nlargest(top_x, 'Increase')
+    return value_df.nsmallest(top_x, 'Increase')
 
-def safe_convert(val):
-    try:
-        return float(val)
-    except ValueError:
-        return np.nan
+
+def calculate_topn(df, year, month, months_back, feature, top_x):
+    # kept for existing callers, formats the percentage column as text
+    top_ics_df = top_movers(build_cube(df), year, month, feature, months_back, top_x)
+    top_ics_df['Percentage Increase'] = top_ics_df['Percentage Increase'].map('{:,.2f}%'.format)
+    return top_ics_df
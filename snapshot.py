@@ -0,0 +1,133 @@
+import argparse
+import json
+import os
+import shutil
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+import functions
+
+# the top-N tables shown on the National Overview, as (feature, lag) pairs
+TOPN_TABLES = [('Occupancy', 1), ('Capacity', 1), ('Capacity', 6)]
+
+
+def cube_frame(cube):
+    # long table of every measure by month for each ICB, region and the nation
+    measures = functions.CUBE_MEASURES + functions.DERIVED_MEASURES
+    n_months = len(cube['dates'])
+    frames = []
+    for level, codes, names, values in [
+            ('ICB', cube['icb_codes'], cube['icb_names'], cube['icb']),
+            ('Region', cube['regions'], cube['regions'], cube['region']),
+            ('National', ['England'], ['England'], {m: v[:, None] for m, v in cube['national'].items()})]:
+        frame = pd.DataFrame({
+            'Level': level,
+            'Date': np.repeat(cube['dates'], len(codes)),
+            'Code': np.tile(codes, n_months),
+            'Name': np.tile(names, n_months),
+            **{measure: values[measure].ravel() for measure in measures}})
+        if level == 'ICB':
+            frame = frame[cube['present'].ravel()]
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True)
+
+
+def movers_frame(cube):
+    # long table of every month-over-month and N-month delta per ICB
+    movers = functions.get_movers(cube)
+    n_months, n_icbs = cube['present'].shape
+    frames = []
+    for (feature, lag), mover in movers.items():
+        frames.append(pd.DataFrame({
+            'Feature': feature,
+            'Lag': lag,
+            'Date': np.repeat(cube['dates'], n_icbs),
+            'ICB23CD': np.tile(cube['icb_codes'], n_months),
+            'ICB23NMS': np.tile(cube['icb_names'], n_months),
+            'Previous': mover['previous'].ravel(),
+            'Current': mover['current'].ravel(),
+            'Increase': mover['increase'].ravel(),
+            'Percentage_Increase': mover['percent'].ravel()}))
+    return pd.concat(frames, ignore_index=True).dropna(subset=['Increase'])
+
+
+def topn_frame(movers, top_x):
+    # the dashboard's top-N increase tables for every month, ties broken by ICB name as in top_movers()
+    tables = pd.DataFrame(TOPN_TABLES, columns=['Feature', 'Lag'])
+    topn = movers.merge(tables).sort_values('ICB23NMS').sort_values('Increase', ascending=False, kind='stable')
+    topn = topn.groupby(['Feature', 'Lag', 'Date']).head(top_x)
+    topn['Rank'] = topn.groupby(['Feature', 'Lag', 'Date']).cumcount() + 1
+    return topn.sort_values(['Feature', 'Lag', 'Date', 'Rank']).reset_index(drop=True)
+
+
+def _write_table(df, snapshot_dir, name):
+    df.to_csv(os.path.join(snapshot_dir, f'{name}.csv'), index=False)
+    df.to_json(os.path.join(snapshot_dir, f'{name}.json'), orient='records', date_format='iso')
+    return [f'{name}.csv', f'{name}.json']
+
+
+def write_snapshot(output_path=functions.SNAPSHOT_PATH, top_x=5, workers=None):
+    version = functions.get_data_version()
+    vw_data = functions.get_vw_dataset(workers=workers)
+    cube = functions.get_cube(vw_data, version)
+
+    # build into a temp directory and swap it in so readers only ever see complete snapshots
+    snapshot_dir = os.path.join(output_path, version)
+    temp_dir = f"{snapshot_dir}.{os.getpid()}.tmp"
+    os.makedirs(temp_dir)
+    try:
+        vw_data.to_parquet(os.path.join(temp_dir, 'vw_dataset.parquet'), index=False)
+        artifacts = ['vw_dataset.parquet']
+        artifacts += _write_table(cube_frame(cube), temp_dir, 'cube')
+        movers = movers_frame(cube)
+        artifacts += _write_table(movers, temp_dir, 'movers')
+        artifacts += _write_table(topn_frame(movers, top_x), temp_dir, 'topn')
+
+        for tier in functions.GEOJSON_TIERS:
+            functions.load_geometry(tier)
+            geojson_file = functions.GEOJSON_TIER_OUTPUT.format(tier=tier)
+            shutil.copy(geojson_file, temp_dir)
+            artifacts.append(os.path.basename(geojson_file))
+
+        with open(os.path.join(temp_dir, functions.SNAPSHOT_MANIFEST), 'w') as f:
+            json.dump({
+                'version': version,
+                'pipeline': functions.PIPELINE_VERSION,
+                'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                'sources': [os.path.basename(file_path) for file_path in functions._source_files()],
+                'months': [date.strftime('%Y-%m') for date in cube['dates']],
+                'rows': len(vw_data),
+                'artifacts': artifacts}, f, indent=2)
+
+        if os.path.exists(snapshot_dir):
+            shutil.rmtree(snapshot_dir)
+        os.replace(temp_dir, snapshot_dir)
+    except Exception:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        raise
+
+    # point LATEST at the new snapshot
+    latest_file = os.path.join(output_path, functions.SNAPSHOT_LATEST)
+    with open(f"{latest_file}.tmp", 'w') as f:
+        f.write(version)
+    os.replace(f"{latest_file}.tmp", latest_file)
+    return snapshot_dir
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build a versioned snapshot of the SITREP dataset and its aggregates.')
+    parser.add_argument('--download', action='store_true', help='check NHS England for new reports first')
+    parser.add_argument('--output', default=functions.SNAPSHOT_PATH, help='directory to write snapshots to')
+    parser.add_argument('--top', type=int, default=5, help='rows per top-N table')
+    parser.add_argument('--workers', type=int, default=functions.PARSE_WORKERS or None,
+                        help='worker processes for parsing workbooks, defaults to SITREP_PARSE_WORKERS or every CPU')
+    args = parser.parse_args()
+
+    if args.download:
+        new_download_count, total_download_count = functions.download_and_rename_files()
+        print(f"{new_download_count} new monthly report(s), {total_download_count} monthly report(s) available")
+    print(f"snapshot written to {write_snapshot(args.output, args.top, args.workers)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+import logging
+import threading
+import time
+from types import MappingProxyType
+import numpy as np
+import functions
+
+logger = logging.getLogger(__name__)
+
+
+def _freeze(value):
+    # read-only views of the cube's arrays, so no session can change data another session sees
+    if isinstance(value, np.ndarray):
+        value = value.view()
+        value.flags.writeable = False
+        return value
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    return value
+
+
+class DataStore:
+    # process-wide dataset and cube for one data version, shared by every session and swapped whole on refresh
+
+    def __init__(self):
+        self.builds = 0
+        self._current = None
+        self._failed_version = None
+        self._build_lock = threading.Lock()
+
+    @property
+    def version(self):
+        current = self._current
+        return current['version'] if current else None
+
+    def get(self, refresh=False):
+        # a refresh blocks for a build already in progress instead of returning the data it replaces,
+        # and retries a version whose build failed
+        current = self._current
+        version = functions.get_data_version()
+        if current and (current['version'] == version or version == self._failed_version and not refresh):
+            functions.count_cache('data store', True)
+            return current
+
+        # one caller builds, the others keep serving the data they have or, with none yet, wait for the build
+        if not self._build_lock.acquire(blocking=refresh or current is None):
+            functions.count_cache('data store', True)
+            return current
+        try:
+            current = self._current
+            if current and current['version'] == version:
+                functions.count_cache('data store', True)
+                return current
+            functions.count_cache('data store', False)
+            try:
+                return self._build(version)
+            except Exception:
+                # keep serving the last good data, the failed version is only built again once the files
+                # change or a refresh asks for it
+                self._failed_version = version
+                if current is None or refresh:
+                    raise
+                logger.exception("building data version %s failed, still serving %s", version, current['version'])
+                return current
+        finally:
+            self._build_lock.release()
+
+    def _build(self, version):
+        with functions.timed_stage('load dataset'):
+            vw_data = functions.get_vw_dataset()
+        with functions.timed_stage('get cube'):
+            cube = functions.get_cube(vw_data, version)
+
+        # publish by replacing the one reference, readers see the old or the new data, never a mix
+        self._current = MappingProxyType({'version': version, 'dataset': vw_data, 'cube': _freeze(cube)})
+        self._failed_version = None
+        self.builds += 1
+        return self._current
+
+    @staticmethod
+    def geometry(tier=functions.GEOJSON_DEFAULT_TIER):
+        # geometry doesn't depend on the data version, functions.load_geometry already keeps one copy per tier
+        return functions.load_geometry(tier)
+
+
+class RefreshWorker:
+    # refreshes the store on a background thread, one refresh at a time per process, optionally on a timer
+
+    def __init__(self, store):
+        self.store = store
+        self._refresh_lock = threading.Lock()
+        self._status_lock = threading.Lock()
+        self._status = {'state': 'idle', 'done': 0, 'total': 0, 'new': 0, 'error': None,
+                        'started': None, 'finished': None, 'version': None}
+        self._poller = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self):
+        return self._refresh_lock.locked()
+
+    def status(self):
+        # a copy for the UI to poll, state is one of idle, downloading, loading, done or failed
+        with self._status_lock:
+            return dict(self._status)
+
+    def _update(self, **status):
+        with self._status_lock:
+            self._status.update(status)
+
+    def start(self):
+        # start a refresh unless one is already running, says whether this call started it
+        if not self._refresh_lock.acquire(blocking=False):
+            return False
+        self._update(state='downloading', done=0, total=0, new=0, error=None, started=time.time(), finished=None)
+        try:
+            threading.Thread(target=self._run, name='sitrep-refresh', daemon=True).start()
+        except Exception:
+            self._refresh_lock.release()
+            raise
+        return True
+
+    def _run(self):
+        try:
+            # new reports are renamed into place whole, the store keeps its current data if either step fails
+            with functions.timed_stage('refresh'):
+                new_download_count, total_download_count = functions.download_and_rename_files(
+                    progress=lambda done, total: self._update(done=done, total=total))
+                self._update(state='loading', new=new_download_count, total=total_download_count)
+                # wait out a build a session started on the old files, so done always means the new data is live
+                self.store.get(refresh=True)
+            self._update(state='done')
+        except Exception as e:
+            logger.exception("background refresh failed")
+            self._update(state='failed', error=str(e))
+        finally:
+            self._update(finished=time.time(), version=self.store.version)
+            self._refresh_lock.release()
+
+    def poll(self, seconds):
+        # check for new reports every `seconds` from now on, started once per process
+        with self._status_lock:
+            if self._poller or not seconds:
+                return
+            self._poller = threading.Thread(target=self._poll, args=(seconds,), name='sitrep-refresh-poll',
+                                            daemon=True)
+        self._poller.start()
+
+    def _poll(self, seconds):
+        while not self._stop.wait(seconds):
+            self.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+data_store = DataStore()
+refresh_worker = RefreshWorker(data_store)